@@ -0,0 +1,311 @@
+from collections import deque
+from change_tracker import ChangeTracker
+from interpreter import Interpreter
+from time import perf_counter
+import board
+import cmd
+import turn_handler
+import logging
+
+# Setup logging
+logger = logging.getLogger(__name__)
+logger.setLevel(1)
+
+# Sensors whose values depend on the positions of other units. Reads of these are validated on the unit's turn
+BOARD_SENSORS = ["num_adjacent_allies", "num_adjacent_enemies", "num_total_allies", "num_total_enemies",
+                 "distance_from_closest_ally", "distance_from_closest_enemy"]
+PLAYER_SENSORS = ["num_total_allies", "num_total_enemies", "get_unit_limit"]  # Same value for all units of a player
+IMPURE_COMMANDS = ["define", "if_else", "prnt"]  # Non-critical commands with effects beyond returning a value
+SCRIPT_NAMES = {"and": "i_and", "or": "i_or"}  # Script command names which differ in the Commands class
+
+# Prefixes are only evaluated ahead for players for which at least this fraction of them was committed in the last
+# round evaluated ahead (units that keep moving towards each other invalidate most reads)
+MIN_COMMIT_RATE = 0.5
+# Whether it is faster to evaluate a player's prefixes or to simply interpret its scripts depends on the script and the
+# board. Both are timed on the same round, by having up to PROBE_UNITS of the player's units do the one which was
+# slower so far (or half of them, until both have been timed), and the faster one is used in between. This is done every
+# PROBE_INTERVAL rounds, along with measuring the commit rate again
+PROBE_INTERVAL = 16
+PROBE_UNITS = 8
+
+
+class NotPure(Exception):
+    # Raised when an expression cannot be evaluated ahead of the unit's turn
+    pass
+
+
+def compile_pure(expr):
+    # Compile an expression made only of numbers, symbols, sensors and arithmetic into a tree of nodes: ("number",
+    # value), ("symbol", name) or ("command", name, [argument nodes]), with command names as in the Commands class
+    if Interpreter.is_number(expr):
+        return "number", Interpreter.get_number_value(expr)
+    if Interpreter.is_symbol(expr):
+        return "symbol", expr
+    if not Interpreter.is_command(expr):
+        raise NotPure()
+    name = Interpreter.get_cmd(expr)
+    name = SCRIPT_NAMES.get(name, name)
+    member = getattr(cmd.Commands, name, None)
+    if name.startswith("_") or name in IMPURE_COMMANDS or member is None or getattr(member, "is_critical", False):
+        raise NotPure()
+    args = []
+    for arg in Interpreter.get_args(expr):
+        arg_exprs = Interpreter.parse(arg)
+        if len(arg_exprs) != 1:
+            raise NotPure()
+        args.append(compile_pure(arg_exprs[0]))
+    return "command", name, args
+
+
+def compile_pure_define(expr):
+    # Compile a define statement whose value is pure, returning the symbol defined and the compiled value
+    if not Interpreter.is_command(expr) or Interpreter.get_cmd(expr) != "define":
+        raise NotPure()
+    args = Interpreter.get_args(expr)
+    symbol = Interpreter.parse(args[0]) if len(args) == 2 else []
+    if len(symbol) != 1 or Interpreter.is_number(symbol[0]) or not Interpreter.is_symbol(symbol[0]):
+        raise NotPure()
+    value = Interpreter.parse(args[1])
+    if len(value) != 1:
+        raise NotPure()
+    return symbol[0], compile_pure(value[0])
+
+
+def node_cost(node):
+    # Instruction budget cost of evaluating a compiled node, as counted by Interpreter.eval_and_exec
+    if node[0] != "command":
+        return 0
+    return cmd.COMMAND_COSTS.get(node[1], cmd.DEFAULT_COMMAND_COST) + sum(node_cost(arg) for arg in node[2])
+
+
+class SplitScript:
+    # A script split into its pure prefix (the leading define statements whose values only depend on sensors,
+    # arithmetic and the unit's variables) and the remaining statements
+    def __init__(self, interpreter, script):
+        self.script = interpreter.analyze_script(script)
+        exprs = Interpreter.parse(script)
+        self.prefix = []  # (symbol, compiled value) for each define statement of the prefix
+        for expr in exprs:
+            try:
+                self.prefix.append(compile_pure_define(expr))
+            except NotPure:
+                break
+        self.prefix_cost = sum(cmd.DEFAULT_COMMAND_COST + node_cost(value) for _, value in self.prefix)
+        self.suffix = interpreter.analyze_script(" ".join(exprs[len(self.prefix):]))
+
+
+class BatchedExecutor:
+    # This class evaluates the pure prefix of every unit's script at the start of a round, in one pass over the units
+    # of each player, instead of interpreting it on each unit's turn. Sensors which have the same value for all units
+    # of a player are read once per player, and distances to the closest units are found through a spatial index of
+    # the units. On each unit's turn, the sensor values it read are validated against the changes made to the board
+    # since the start of the round (see ChangeTracker); if they are no longer valid, the prefix is evaluated again
+    # against the current board. The variables defined by the prefix are then committed and only the rest of the script
+    # is interpreted. The game therefore plays out exactly as it would with serial execution. Players whose prefixes
+    # are mostly invalidated have them evaluated on each unit's turn only (see MIN_COMMIT_RATE), and the scripts of
+    # players for which this is no faster than interpreting them are simply interpreted (see PROBE_INTERVAL).
+    def __init__(self, board_r, turn_handler_r, interpreter, scripts, run_script):
+        self.board = board_r
+        self.turn_handler = turn_handler_r
+        self.run_script = run_script  # Executes a script closure for the acting unit, see Game.run_script
+        self.tracker = ChangeTracker(board_r)
+        self.split_scripts = {player_id: SplitScript(interpreter, script) for player_id, script in scripts.items()}
+
+        # Sensors are read through commands attached to a turn handler of their own, whose only unit is the one being
+        # evaluated
+        self.evaluation_turn_handler = turn_handler.TurnHandler()
+        self.commands = cmd.Commands(board_r, self.evaluation_turn_handler)
+
+        # Spatial index of the units, kept up to date as they move in rounds in which any prefixes are evaluated (see
+        # track_changes). Sparse boards already index their units
+        self.unit_index = None
+        self.tracking = True  # Whether the board's changes are being tracked
+        self.track_changes(False)
+        self.player_sensors = {}  # (player_id, sensor) -> value, shared by the units of the player while it is valid
+        self.results = {}  # Unit id -> (variables, reads) for the current round
+        self.round_number = 0
+        self.commit_rates = {}  # player_id -> fraction of the prefixes evaluated ahead that were committed
+        self.round_counts = {}  # player_id -> [prefixes committed, prefixes validated] in the current round
+        self.batched_units = set()  # Ids of the units whose prefixes are evaluated in the current round
+        self.turn_times = {}  # player_id -> {whether prefixes were evaluated: average time per turn}
+        self.round_times = {}  # player_id -> {whether prefixes are evaluated: [time spent, turns]}, in probing rounds
+        self.num_committed = 0
+        self.num_reevaluated = 0
+        self.num_full = 0
+
+    def shutdown(self):
+        logger.log(10, "Batched execution: " + str(self.num_committed) + " script prefixes committed, "
+                   + str(self.num_reevaluated) + " evaluated again, " + str(self.num_full)
+                   + " scripts executed in full")
+
+    def on_tile_changed(self, loc, unit):
+        self.unit_index[loc] = self.board.get_unit_in_loc(loc)
+
+    def track_changes(self, tracking):
+        # Start or stop listening to the board's changes. This is only needed in rounds in which prefixes are evaluated,
+        # and listening costs time on every move; the spatial index is rebuilt when listening starts again
+        if tracking == self.tracking:
+            return
+        self.tracking = tracking
+        listeners = self.board.tile_change_listeners
+        if not tracking:
+            listeners.remove(self.tracker.on_tile_changed)
+            if self.unit_index is not None:
+                listeners.remove(self.on_tile_changed)
+            return
+        listeners.append(self.tracker.on_tile_changed)
+        if isinstance(self.board.board_matrix, board.BoardMatrix):
+            self.unit_index = board.SparseBoardMatrix(self.board.board_size)
+            for t_unit in self.turn_handler.queue:
+                self.unit_index[t_unit.loc] = t_unit
+            listeners.append(self.on_tile_changed)
+
+    def start_round(self):
+        # Decide which units have their prefixes evaluated this round, and evaluate them ahead against the current board
+        # for the players for which this pays off
+        self.tracker.reset()
+        self.results = {}
+        self.player_sensors = {}
+        for player_id, (num_committed, num_validated) in self.round_counts.items():
+            if num_validated:
+                self.commit_rates[player_id] = num_committed / num_validated
+        for player_id, round_times in self.round_times.items():
+            times = self.turn_times.setdefault(player_id, {})
+            for batched, (time_spent, num_turns) in round_times.items():
+                if num_turns:
+                    time_per_turn = time_spent / num_turns
+                    times[batched] = (times[batched] + time_per_turn) / 2 if batched in times else time_per_turn
+        self.round_counts = {}
+        self.round_times = {}
+        self.batched_units = set()
+
+        turn_budget = self.turn_handler.turn_budget
+        for player_id, player_r in self.board.players.items():
+            split_script = self.split_scripts[player_id]
+            if not split_script.prefix or (turn_budget is not None and split_script.prefix_cost > turn_budget):
+                continue
+            times = self.turn_times.get(player_id, {})
+            if len(times) < 2 or self.round_number % PROBE_INTERVAL == 0:
+                self.round_times[player_id] = {True: [0.0, 0], False: [0.0, 0]}
+                all_units = sorted(player_r.units, key=lambda t_unit: t_unit.id)
+                step = 2 if len(times) < 2 else max(2, len(all_units) // PROBE_UNITS)
+                units = all_units[self.round_number % step::step]
+                if len(times) == 2 and times[True] <= times[False]:
+                    sampled = set(units)
+                    units = [t_unit for t_unit in all_units if t_unit not in sampled]
+            elif times[True] <= times[False]:
+                units = player_r.units
+            else:
+                continue
+            self.batched_units.update(t_unit.id for t_unit in units)
+            if player_id not in self.round_times and self.commit_rates.get(player_id, 1) < MIN_COMMIT_RATE:
+                continue
+            self.track_changes(True)
+            start = perf_counter()
+            self.round_counts[player_id] = [0, 0]
+            for t_unit in units:
+                result = self.evaluate_prefix(t_unit, split_script.prefix, 1)
+                if result is not None:
+                    self.results[t_unit.id] = result
+            if player_id in self.round_times:
+                self.round_times[player_id][True][0] += perf_counter() - start
+        self.track_changes(bool(self.batched_units))
+        self.round_number += 1
+
+    def evaluate_prefix(self, t_unit, prefix, turns_ahead=0):
+        # Evaluate the prefix as it would be evaluated on the unit's turn, returning the resulting variables and the
+        # board sensor values read, or None if it fails (it is then executed in full, so that it fails the same way).
+        # When evaluating ahead of the unit's turn, its turn number is incremented while evaluating, as it will be by
+        # then. The board does not change during the prefix, so each sensor is only read once.
+        variables = dict(t_unit.var_data)
+        reads = {}  # Sensor -> value
+        self.evaluation_turn_handler.queue = deque([t_unit])
+        t_unit.unit_turn_number += turns_ahead
+        try:
+            for symbol, value in prefix:
+                variables[symbol] = self.resolve(self.evaluate(value, t_unit, variables, reads), variables)
+        except Exception:
+            return None
+        finally:
+            t_unit.unit_turn_number -= turns_ahead
+        return variables, [(sensor, value) for sensor, value in reads.items() if sensor in BOARD_SENSORS]
+
+    @staticmethod
+    def resolve(value, variables):
+        # Symbols are replaced by their values, as in Interpreter.get_symbol_value
+        if Interpreter.is_symbol(value):
+            if value not in variables:
+                raise Exception("Undefined symbol " + value)
+            return variables[value]
+        return value
+
+    def evaluate(self, node, t_unit, variables, reads):
+        if node[0] != "command":
+            return node[1]
+        name = node[1]
+        args = [self.resolve(self.evaluate(arg, t_unit, variables, reads), variables) for arg in node[2]]
+        if args:
+            return getattr(cmd.Commands, name)(*args)
+        if name not in reads:
+            reads[name] = self.read_sensor(name, t_unit)
+        return reads[name]
+
+    def read_sensor(self, sensor, t_unit):
+        if sensor in PLAYER_SENSORS:
+            key = (t_unit.player_id, sensor)
+            if key not in self.player_sensors:
+                self.player_sensors[key] = getattr(self.commands, sensor)()
+            return self.player_sensors[key]
+        # Distances are looked up in the spatial index, unless the closest unit is far enough away that the board's own
+        # linear search (over the allies or enemies only) is faster
+        if self.unit_index is not None and sensor == "distance_from_closest_ally":
+            return self.unit_index.distance_to_closest(
+                t_unit.loc, lambda other: other.player_id == t_unit.player_id and other != t_unit,
+                self.board.distance_between_locs, self.board.board_size[0] + self.board.board_size[1],
+                getattr(self.commands, sensor))
+        if self.unit_index is not None and sensor == "distance_from_closest_enemy":
+            return self.unit_index.distance_to_closest(
+                t_unit.loc, lambda other: other.player_id != t_unit.player_id,
+                self.board.distance_between_locs, self.board.board_size[0] + self.board.board_size[1],
+                getattr(self.commands, sensor))
+        return getattr(self.commands, sensor)()
+
+    def execute_turn(self, acting_unit):
+        # Execute the acting unit's script, timing it in probing rounds. Always succeeds
+        batched = acting_unit.id in self.batched_units
+        round_times = self.round_times.get(acting_unit.player_id)
+        start = perf_counter()
+        if batched:
+            self.execute_split_script(acting_unit)
+        else:
+            self.run_script(self.split_scripts[acting_unit.player_id].script)
+            self.num_full += 1
+        if round_times is not None:
+            round_times[batched][0] += perf_counter() - start
+            round_times[batched][1] += 1
+        return True
+
+    def execute_split_script(self, acting_unit):
+        # Commit the prefix of the acting unit's script, evaluating it again if the board changed in a way which affects
+        # it (or if the unit was not there at the start of the round), and execute the rest of its script. If the prefix
+        # cannot be evaluated, the whole script is executed instead
+        split_script = self.split_scripts[acting_unit.player_id]
+        result = self.results.pop(acting_unit.id, None)
+        if result is not None:
+            self.round_counts[acting_unit.player_id][1] += 1
+        if result is not None and all(self.tracker.read_is_valid(acting_unit, sensor, value)
+                                      for sensor, value in result[1]):
+            self.round_counts[acting_unit.player_id][0] += 1
+            self.num_committed += 1
+        else:
+            self.player_sensors = {}  # Values read at the start of the round may be stale
+            result = self.evaluate_prefix(acting_unit, split_script.prefix)
+            if result is None:
+                self.run_script(split_script.script)
+                self.num_full += 1
+                return
+            self.num_reevaluated += 1
+        acting_unit.var_data = result[0]
+        if self.turn_handler.turn_budget is not None:
+            self.turn_handler.budget_used += split_script.prefix_cost
+        self.run_script(split_script.suffix)
@@ -0,0 +1,291 @@
+from concurrent.futures import ProcessPoolExecutor
+from time import perf_counter
+import multiprocessing
+import itertools
+import platform
+import resource
+import argparse
+import logging
+import json
+import time
+import sys
+import os
+import game
+
+STRATEGIES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "strategies")
+
+# DEFAULT BENCHMARK MATRIX
+BOARD_SIZES = [20, 50, 100, 200, 500]
+PLAYER_COUNTS = [2, 4, 8]
+UNIT_LIMIT_PCTS = [0.01, 0.05]
+STRATEGY_FAMILIES = ["bundled", "deep_nesting", "sensor_heavy", "spawn_spam"]
+TURNS = 2000  # Turn limit for each benchmarked game
+SEED = 0
+
+# Smaller matrix for quick checks
+QUICK_BOARD_SIZES = [20, 100]
+QUICK_PLAYER_COUNTS = [2, 4]
+QUICK_UNIT_LIMIT_PCTS = [0.05]
+
+
+########################################################################################################################
+# Strategy families
+########################################################################################################################
+
+def read_strategy(name):
+    with open(os.path.join(STRATEGIES_DIR, name), 'r') as input_file:
+        return input_file.read()
+
+
+def deep_nesting_script(depth=25):
+    # Worst case for the interpreter's recursion: deeply nested conditionals and arithmetic
+    value = "1"
+    for _ in range(depth):
+        value = "add(" + value + ", 1)"
+    action = "move()"
+    for level in range(depth):
+        action = "if_else(lt(v, " + str(depth + level + 100) + "), " + action + ", wait())"
+    return "define(v, " + value + ")\n" \
+           + "if(eq(distance_from_closest_enemy(), 1), attack())\n" \
+           + "if(lt(num_total_allies(), div(get_unit_limit(), 2)), spawn())\n" \
+           + action
+
+
+def sensor_heavy_script(repeats=5):
+    # Worst case for the board queries: every sensor read several times per turn
+    sensors = ["distance_from_closest_enemy", "distance_from_closest_ally", "num_adjacent_enemies",
+               "num_adjacent_allies", "num_total_enemies", "num_total_allies"]
+    lines = []
+    for idx in range(repeats):
+        for sensor_idx, sensor in enumerate(sensors):
+            lines.append("define(s" + str(sensor_idx) + "r" + str(idx) + ", " + sensor + "())")
+    lines.append("if(eq(s0r0, 1), attack())")
+    lines.append("if(lt(s5r0, get_unit_limit()), spawn())")
+    lines.append("move()")
+    return "\n".join(lines)
+
+
+def spawn_spam_script():
+    # Worst case for the number of units: spawn whenever possible, without ever fighting
+    return "spawn()"
+
+
+def family_scripts(family, num_players):
+    # Return the script of each player for the given strategy family
+    if family == "bundled":
+        bundled = [read_strategy("test1.txt"), read_strategy("test2.txt")]
+        return [bundled[idx % 2] for idx in range(num_players)]
+    if family == "deep_nesting":
+        return [deep_nesting_script()] * num_players
+    if family == "sensor_heavy":
+        return [sensor_heavy_script()] * num_players
+    if family == "spawn_spam":
+        return [spawn_spam_script()] * num_players
+    raise Exception("Unknown strategy family " + family)
+
+
+########################################################################################################################
+# Running benchmarks
+########################################################################################################################
+
+def case_name(case):
+    return (case["family"] + "-" + str(case["board_size"]) + "x" + str(case["board_size"])
+            + "-p" + str(case["num_players"]) + "-u" + str(case["unit_limit_pct"]))
+
+
+def build_cases(board_sizes, player_counts, unit_limit_pcts, families, turns, seed, game_config):
+    return [{"family": family, "board_size": board_size, "num_players": num_players,
+             "unit_limit_pct": unit_limit_pct, "turns": turns, "seed": seed, "game_config": game_config}
+            for family, board_size, num_players, unit_limit_pct
+            in itertools.product(families, board_sizes, player_counts, unit_limit_pcts)]
+
+
+_nested_times = []  # Time spent in nested instrumented calls, for each instrumented call in progress
+
+
+def instrument(obj, method_name, phase, timings):
+    # Replace a method of an object by one that adds the time spent in it to the given phase. Time spent in instrumented
+    # methods it calls is only counted in their own phases
+    method = getattr(obj, method_name)
+
+    def timed(*args, **kwargs):
+        start = perf_counter()
+        _nested_times.append(0.0)
+        try:
+            return method(*args, **kwargs)
+        finally:
+            elapsed = perf_counter() - start
+            timings[phase] += elapsed - _nested_times.pop()
+            if _nested_times:
+                _nested_times[-1] += elapsed
+
+    setattr(obj, method_name, timed)
+
+
+def instrument_round_executor(g, timings):
+    # The round executor of the speculative and batched execution modes only exists once the game has started, so it is
+    # instrumented on the first turn. Turns it executes count as script time, whether or not they call run_script
+    turn = g.turn
+
+    def first_turn():
+        g.turn = turn
+        if g.round_executor is not None:
+            instrument(g.round_executor, "start_round", "round_start", timings)
+            instrument(g.round_executor, "execute_turn", "script", timings)
+        return turn()
+
+    g.turn = first_turn
+
+
+def peak_memory_mb():
+    # ru_maxrss is in bytes on macOS, and in kilobytes on Linux and other platforms
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+def run_case(case):
+    # Play a single headless game and measure it. Each case is run in a fresh process so that the peak memory usage
+    # reflects that case alone.
+    logging.disable(logging.CRITICAL)
+    timings = {"analyze": 0.0, "spawn_initial_units": 0.0, "round_start": 0.0, "start_turn": 0.0, "script": 0.0,
+               "end_turn": 0.0, "display": 0.0, "remove_losing_players": 0.0}
+
+    g = game.Game(scripts=family_scripts(case["family"], case["num_players"]),
+                  board_size=[case["board_size"], case["board_size"]], unit_limit_pct=case["unit_limit_pct"],
+                  turn_limit=case["turns"], seed=case["seed"], headless=True, **case["game_config"])
+
+    instrument(g, "populate_players", "analyze", timings)
+    instrument(g, "run_script", "script", timings)
+    instrument(g, "spawn_initial_units", "spawn_initial_units", timings)
+    instrument(g.turn_handler, "start_turn", "start_turn", timings)
+    instrument(g.turn_handler, "end_turn", "end_turn", timings)
+    instrument(g, "display_board", "display", timings)
+    instrument(g, "remove_losing_players", "remove_losing_players", timings)
+    instrument_round_executor(g, timings)
+
+    start = perf_counter()
+    g.start_game()
+    wall_time = perf_counter() - start
+
+    timings["other"] = max(wall_time - sum(timings.values()), 0.0)
+    num_turns = g.turn_handler.turn_number
+    result = dict(case)
+    result.update({
+        "name": case_name(case),
+        "num_turns": num_turns,
+        "wall_time": wall_time,
+        "turns_per_sec": num_turns / wall_time if wall_time > 0 else 0.0,
+        "peak_memory_mb": peak_memory_mb(),
+        "analyze_time": timings["analyze"],
+        "phases": timings,
+        "final_units": sum(player_r.num_units() for player_r in g.players.values()),
+    })
+    return result
+
+
+def run_benchmarks(cases, jobs=1):
+    # Run all cases, each in its own fresh process. Running several jobs at once finishes sooner, but the cases then
+    # compete for CPU and memory bandwidth, so timings are less reliable.
+    context = multiprocessing.get_context("spawn")
+    results = []
+    with ProcessPoolExecutor(max_workers=jobs, mp_context=context, max_tasks_per_child=1) as pool:
+        for result in pool.map(run_case, cases):
+            print(format_result(result))
+            sys.stdout.flush()
+            results.append(result)
+    return {"meta": {"python": platform.python_version(), "platform": platform.platform(),
+                     "time": time.strftime("%Y-%m-%dT%H:%M:%S")},
+            "cases": results}
+
+
+def format_result(result):
+    phases = result["phases"]
+    return (result["name"].ljust(36) + " " + ("%.1f turns/s" % result["turns_per_sec"]).rjust(16)
+            + ("%.1f MB" % result["peak_memory_mb"]).rjust(12) + ("analyze %.4fs" % result["analyze_time"]).rjust(18)
+            + "  " + " ".join(phase + "=" + "%.3f" % phases[phase] for phase in phases if phase != "analyze"))
+
+
+########################################################################################################################
+# Comparing results
+########################################################################################################################
+
+def compare_results(baseline, current, threshold):
+    # Compare two result sets case by case. A case regresses if its throughput dropped, or its peak memory usage grew,
+    # by more than the threshold (a fraction of the baseline value). Returns the list of regression messages.
+    baseline_cases = {result["name"]: result for result in baseline["cases"]}
+    regressions = []
+    for result in current["cases"]:
+        base = baseline_cases.get(result["name"])
+        if base is None:
+            print(result["name"].ljust(36) + " (not in baseline)")
+            continue
+        speed_change = result["turns_per_sec"] / base["turns_per_sec"] - 1 if base["turns_per_sec"] else 0.0
+        memory_change = result["peak_memory_mb"] / base["peak_memory_mb"] - 1 if base["peak_memory_mb"] else 0.0
+        flags = []
+        if speed_change < -threshold:
+            flags.append("SLOWER")
+        if memory_change > threshold:
+            flags.append("MORE MEMORY")
+        print(result["name"].ljust(36) + ("%+.1f%% turns/s" % (100 * speed_change)).rjust(18)
+              + ("%+.1f%% memory" % (100 * memory_change)).rjust(16) + "  " + " ".join(flags))
+        if flags:
+            regressions.append(result["name"] + ": " + ", ".join(flags))
+    return regressions
+
+
+def load_results(path):
+    with open(path, 'r') as input_file:
+        return json.load(input_file)
+
+
+def main():
+    # Argument parsing
+    parser = argparse.ArgumentParser(description="Benchmark headless games across a matrix of configurations")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="Run the benchmark matrix and save the results as JSON")
+    run_parser.add_argument('-o', '--output', default="benchmark_results.json", help='Path for the results file')
+    run_parser.add_argument('--quick', action='store_true', help='Run a smaller matrix')
+    run_parser.add_argument('--sizes', type=int, nargs='*', help='Board sizes (the board is size x size)')
+    run_parser.add_argument('--players', type=int, nargs='*', help='Numbers of players')
+    run_parser.add_argument('--unit-limits', type=float, nargs='*', help='Unit limits (%% of board capacity)')
+    run_parser.add_argument('--families', nargs='*', choices=STRATEGY_FAMILIES, help='Strategy families')
+    run_parser.add_argument('--turns', type=int, default=TURNS, help='Turn limit for each game')
+    run_parser.add_argument('--seed', type=int, default=SEED, help='Seed for each game')
+    run_parser.add_argument('--config', type=json.loads, default={},
+                            help='Additional game parameters as JSON, e.g. \'{"execution_mode": "speculative"}\'')
+    run_parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of cases run at once')
+    run_parser.add_argument('--baseline', help='Compare the results against this results file')
+    run_parser.add_argument('--threshold', type=float, default=0.1, help='Regression threshold (fraction)')
+
+    compare_parser = subparsers.add_parser("compare", help="Compare a results file against a baseline")
+    compare_parser.add_argument('baseline', help='Baseline results file')
+    compare_parser.add_argument('current', help='Results file to check')
+    compare_parser.add_argument('--threshold', type=float, default=0.1, help='Regression threshold (fraction)')
+    args = parser.parse_args()
+
+    if args.command == "run":
+        cases = build_cases(args.sizes or (QUICK_BOARD_SIZES if args.quick else BOARD_SIZES),
+                            args.players or (QUICK_PLAYER_COUNTS if args.quick else PLAYER_COUNTS),
+                            args.unit_limits or (QUICK_UNIT_LIMIT_PCTS if args.quick else UNIT_LIMIT_PCTS),
+                            args.families or STRATEGY_FAMILIES, args.turns, args.seed, args.config)
+        results = run_benchmarks(cases, args.jobs)
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+        if args.baseline is None:
+            return
+        baseline = load_results(args.baseline)
+        current = results
+    else:
+        baseline = load_results(args.baseline)
+        current = load_results(args.current)
+
+    regressions = compare_results(baseline, current, args.threshold)
+    if regressions:
+        print(str(len(regressions)) + " regression(s) beyond " + str(100 * args.threshold) + "%:")
+        for regression in regressions:
+            print("  " + regression)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,11 @@
+from array import array
 from typing import List
 from typing import Union
 from unit import Unit
 from random import choice
 from math import ceil
 from random import randint
+import replay
 import logging
 
 # Setup logging
@@ -11,33 +13,208 @@ logger = logging.getLogger(__name__)
 logger.setLevel(1)
 
 
+class FreeTileIndex:
+    # The set of free tiles of a board, supporting insertion, removal and finding the k-th free tile, all in logarithmic
+    # time. Tiles are numbered x * size[1] + y (row-major order), and the free ones are counted in a Fenwick tree:
+    # entry i (from 1) holds the number of free tiles among the i & -i tiles up to tile i - 1.
+    def __init__(self, size):
+        self.area = size[0] * size[1]
+        self.free = bytearray(b"\x01") * self.area  # Tile -> whether it is free
+        self.counts = array('l', (i & -i for i in range(self.area + 1)))  # All tiles start free
+        self.num_free = self.area
+        self.top_step = 1 << (self.area.bit_length() - 1) if self.area else 0
+
+    def __len__(self):
+        return self.num_free
+
+    def update(self, tile, delta):
+        i = tile + 1
+        while i <= self.area:
+            self.counts[i] += delta
+            i += i & -i
+        self.num_free += delta
+
+    def add(self, tile):
+        if not self.free[tile]:
+            self.free[tile] = 1
+            self.update(tile, 1)
+
+    def remove(self, tile):
+        if self.free[tile]:
+            self.free[tile] = 0
+            self.update(tile, -1)
+
+    def kth_tile(self, k):
+        # Return the k-th free tile (from 0) in row-major order
+        position = 0
+        step = self.top_step
+        while step:
+            if position + step <= self.area and self.counts[position + step] <= k:
+                position += step
+                k -= self.counts[position]
+            step >>= 1
+        return position
+
+
 class BoardMatrix:
     # A wrapper class for the matrix of elements on the board, which takes as an index a list of two values (x index
-    # and y index)
+    # and y index). The free tiles are also indexed, so that a random one can be picked in logarithmic time
     board_matrix: List[List[Union[Unit, None]]]  # Type hinting
 
     def __init__(self, size):
+        self.size = size
         self.board_matrix = [[None for _ in range(size[1])] for _ in range(size[0])]
+        self.free_tiles = FreeTileIndex(size)
 
     def __getitem__(self, loc):
         return self.board_matrix[loc[0]][loc[1]]
 
     def __setitem__(self, loc, value):
         self.board_matrix[loc[0]][loc[1]] = value
+        tile = (loc[0] % self.size[0]) * self.size[1] + loc[1] % self.size[1]
+        if value is None:
+            self.free_tiles.add(tile)
+        else:
+            self.free_tiles.remove(tile)
+
+    def random_free_location(self):
+        # Return a uniformly random free location, or None if the board is full. See Board.get_random_free_location
+        if not self.free_tiles:
+            return None
+        tile = self.free_tiles.kth_tile(randint(0, len(self.free_tiles) - 1))
+        return [tile // self.size[1], tile % self.size[1]]
+
+    def rows(self):
+        # Return the contents of the board as a list of rows
+        return self.board_matrix
+
+
+class SparseBoardMatrix:
+    # A drop-in replacement for BoardMatrix for very large, mostly empty boards. Only occupied tiles are stored, in a
+    # dict keyed by location tuple, so memory scales with the number of units rather than with the area of the board.
+    # Occupied tiles are also bucketed by chunk (a square of CHUNK_SIZE x CHUNK_SIZE tiles), so that the closest unit to
+    # a location can be found by searching the chunks around it, ring by ring, instead of checking every unit.
+    CHUNK_SIZE = 16
+    LINEAR_SCAN_THRESHOLD = 64  # With at most this many units on the board, checking them all is faster
+
+    def __init__(self, size):
+        self.size = size
+        self.num_chunks = [ceil(size[0] / self.CHUNK_SIZE), ceil(size[1] / self.CHUNK_SIZE)]
+        self.tiles = {}  # Location tuple -> unit, for occupied tiles only
+        self.chunks = {}  # Chunk index tuple -> {location tuple -> unit}, for chunks with at least one unit
+
+    def key(self, loc):
+        # Locations are wrapped around the board, the same way negative indices wrap around in BoardMatrix
+        return loc[0] % self.size[0], loc[1] % self.size[1]
+
+    def chunk_of(self, key):
+        return key[0] // self.CHUNK_SIZE, key[1] // self.CHUNK_SIZE
+
+    def __getitem__(self, loc):
+        return self.tiles.get(self.key(loc))
+
+    def __setitem__(self, loc, value):
+        key = self.key(loc)
+        chunk = self.chunk_of(key)
+        if value is None:
+            if self.tiles.pop(key, None) is not None:
+                del self.chunks[chunk][key]
+                if not self.chunks[chunk]:
+                    del self.chunks[chunk]
+            return
+        self.tiles[key] = value
+        self.chunks.setdefault(chunk, {})[key] = value
+
+    def random_free_location(self):
+        # Return a uniformly random free location, or None if the board is full. See Board.get_random_free_location.
+        # The k-th free tile is found by skipping the occupied tiles which come before it
+        num_free = self.size[0] * self.size[1] - len(self.tiles)
+        if num_free == 0:
+            return None
+        tile = randint(0, num_free - 1)
+        for occupied in sorted(x * self.size[1] + y for x, y in self.tiles):
+            if occupied > tile:
+                break
+            tile += 1
+        return [tile // self.size[1], tile % self.size[1]]
+
+    def min_distance_outside(self, key, center, ring):
+        # Lower bound of the distance from a tile to any tile outside the chunks at most ring chunks away from the
+        # center chunk (the tile's own), or None if those chunks cover the whole board
+        bound = None
+        for axis in (0, 1):
+            if 2 * ring + 1 >= self.num_chunks[axis]:
+                continue  # Every chunk along this axis is covered
+            size = self.size[axis]
+            first_tile = (center[axis] - ring) % self.num_chunks[axis] * self.CHUNK_SIZE
+            last_tile = min(((center[axis] + ring) % self.num_chunks[axis] + 1) * self.CHUNK_SIZE, size) - 1
+            axis_bound = min((last_tile - key[axis]) % size + 1, (key[axis] - first_tile) % size + 1)
+            bound = axis_bound if bound is None else min(bound, axis_bound)
+        return bound
+
+    def chunks_in_ring(self, center, ring):
+        # Return the indices of the chunks exactly ring chunks away from the center chunk (wrapping around the board)
+        if ring == 0:
+            return [center]
+        offsets = [(dx, dy) for dx in range(-ring, ring + 1) for dy in (-ring, ring)] \
+            + [(dx, dy) for dx in (-ring, ring) for dy in range(-ring + 1, ring)]
+        return {((center[0] + dx) % self.num_chunks[0], (center[1] + dy) % self.num_chunks[1]) for dx, dy in offsets}
+
+    def distance_to_closest(self, loc, f_bool, distance, default, scan=None):
+        # Return the distance from loc to the closest unit satisfying the boolean function, or default if there is none
+        # closer. Chunks are searched ring by ring around loc, until no unsearched chunk can hold a closer unit. If that
+        # would mean searching more chunks than there are occupied ones, all units are checked instead, or the given
+        # scan function is called (e.g. if the caller can check only the units which may satisfy the function).
+        if scan is None:
+            scan = lambda: self.scan_distance_to_closest(loc, f_bool, distance, default)
+        if len(self.tiles) <= self.LINEAR_SCAN_THRESHOLD:
+            return scan()
+        key = self.key(loc)
+        center = self.chunk_of(key)
+        closest = default
+        num_searched = 0
+        for ring in range(max(self.num_chunks) // 2 + 1):
+            if ring > 0:
+                bound = self.min_distance_outside(key, center, ring - 1)
+                if bound is None or closest <= bound:
+                    break
+            ring_chunks = self.chunks_in_ring(center, ring)
+            num_searched += len(ring_chunks)
+            if num_searched > len(self.chunks):
+                return min(closest, scan())
+            for chunk in ring_chunks:
+                for t_unit in self.chunks.get(chunk, {}).values():
+                    if f_bool(t_unit):
+                        closest = min(closest, distance(loc, t_unit.loc))
+        return closest
+
+    def scan_distance_to_closest(self, loc, f_bool, distance, default):
+        return min([distance(loc, t_unit.loc) for t_unit in self.tiles.values() if f_bool(t_unit)] + [default])
+
+
+BOARD_BACKENDS = {"dense": BoardMatrix, "sparse": SparseBoardMatrix}
 
 
 class Board:
     # This class handles the board_matrix object and the units on it and the manipulation thereof.
     # It also handles all unit- and board_matrix-related commands that should not be directly exposed to the user
 
-    def __init__(self, turn_handler, players, board_size, unit_limit_pct):
+    def __init__(self, turn_handler, players, board_size, unit_limit_pct, board_backend="dense"):
         # Board initialization
         self.turn_handler = turn_handler
         self.players = players
         self.board_size = board_size
         self.unit_limit = ceil(board_size[0] * board_size[1] * unit_limit_pct)
-        self.board_matrix = BoardMatrix(board_size)
+        if board_backend not in BOARD_BACKENDS:
+            raise Exception("Unknown board backend " + str(board_backend))
+        self.board_backend = board_backend
+        self.board_matrix = BOARD_BACKENDS[board_backend](board_size)
         self.num_total_units_spawned = 0
+        self.num_total_units = 0  # Number of units currently on the board, across all players
+        self.pending_eliminations = []  # Ids of players whose last unit was despawned, not yet removed from the game
+        self.event_recorder = None  # If set, a replay.ReplayRecorder which board and unit events are reported to
+        self.tile_change_listeners = []  # Functions called with a location and a unit whenever that unit enters or
+        # leaves the tile at that location
 
         if unit_limit_pct <= 0 or unit_limit_pct > 1:
             raise Exception("Unit limit (% of board capacity) must be greater than 0 and less than or equal to 1")
@@ -57,19 +234,31 @@ class Board:
             return
 
         self.num_total_units_spawned += 1
+        self.num_total_units += 1
         unit_id = self.num_total_units_spawned
         new_unit = Unit(self, unit_id, player_id, loc)
         self.board_matrix[loc] = new_unit
+        self.notify_tile_changed(loc, new_unit)
         self.turn_handler.add_to_queue(new_unit)
         self.players[player_id].units.add(new_unit)
+        if self.event_recorder is not None:
+            self.event_recorder.record(replay.SPAWN, new_unit)
         logger.log(10, "New unit " + str(unit_id) + " spawned by player " + str(player_id) + " in location " + str(loc))
 
     def despawn_unit(self, unit):
         # Remove unit from board
         loc = unit.loc
         self.board_matrix[loc] = None
+        self.notify_tile_changed(loc, unit)
         self.turn_handler.remove_from_queue(unit)
         self.players[unit.player_id].units.remove(unit)
+        self.num_total_units -= 1
+        if self.event_recorder is not None:
+            self.event_recorder.record(replay.DEATH, unit)
+        if self.players[unit.player_id].num_units() == 0:
+            self.pending_eliminations.append(unit.player_id)
+            if self.event_recorder is not None:
+                self.event_recorder.record(replay.ELIMINATION, unit)
 
     def spawn_in_adjacent_location(self, player_id, loc):
         spawn_loc = self.get_free_adjacent_loc(loc)
@@ -84,6 +273,14 @@ class Board:
         unit.loc = new_loc
         self.board_matrix[old_loc] = None
         self.board_matrix[new_loc] = unit
+        self.notify_tile_changed(old_loc, unit)
+        self.notify_tile_changed(new_loc, unit)
+        if self.event_recorder is not None:
+            self.event_recorder.record(replay.MOVE, unit)
+
+    def notify_tile_changed(self, loc, unit):
+        for listener in self.tile_change_listeners:
+            listener(loc, unit)
 
     ####################################################################################################################
     # Functions for use in user-commands
@@ -101,15 +298,23 @@ class Board:
         return self.players[player_id].num_units() - 1
 
     def num_total_enemies(self, player_id):
-        return sum([self.players[t_id].num_units() for t_id in self.players if t_id != player_id])
+        return self.num_total_units - self.players[player_id].num_units()
 
     def distance_from_closest_ally(self, unit):
+        if isinstance(self.board_matrix, SparseBoardMatrix):
+            return self.board_matrix.distance_to_closest(
+                unit.loc, lambda t_unit: t_unit.player_id == unit.player_id and t_unit != unit,
+                self.distance_between_locs, self.board_size[0] + self.board_size[1])
         dist = [self.board_size[0] + self.board_size[1]]
         for ally in self.get_all_allies(unit):
             dist.append(self.distance_between_units(unit, ally))
         return min(dist)
 
     def distance_from_closest_enemy(self, unit):
+        if isinstance(self.board_matrix, SparseBoardMatrix):
+            return self.board_matrix.distance_to_closest(
+                unit.loc, lambda t_unit: t_unit.player_id != unit.player_id,
+                self.distance_between_locs, self.board_size[0] + self.board_size[1])
         dist = [self.board_size[0] + self.board_size[1]]
         for enemy in self.get_all_enemies(unit):
             dist.append(self.distance_between_units(unit, enemy))
@@ -121,14 +326,24 @@ class Board:
             logger.log(10, "Unit " + str(unit.id) + " tried to attack, but no enemy units in range")
             return
         logger.log(10, "Unit " + str(unit.id) + " attacked unit " + str(enemy_unit.id))
+        if self.event_recorder is not None:
+            self.event_recorder.record(replay.ATTACK, unit, enemy_unit.id, dmg)
         enemy_unit.damage(dmg)
 
     ####################################################################################################################
     # Helper functions
     ####################################################################################################################
 
-    def get_random_location(self):
-        return [randint(0, self.board_size[0] - 1), randint(0, self.board_size[1]) - 1]
+    def get_random_free_location(self):
+        # Return a uniformly random free location, or None if the board is full. Every board backend picks the k-th free
+        # tile in row-major order for a random k, so that a given seed places units identically on all of them. This
+        # takes O(log(area)) time on dense boards (see FreeTileIndex), and O(n log n) time for n units on sparse ones
+        return self.board_matrix.random_free_location()
+
+    def occupied_tiles(self):
+        # Return (location tuple, unit) for every unit on the board, with locations wrapped around the board
+        return [((t_unit.loc[0] % self.board_size[0], t_unit.loc[1] % self.board_size[1]), t_unit)
+                for player_r in self.players.values() for t_unit in player_r.units]
 
     def is_free(self, loc):
         return self.board_matrix[loc] is None
@@ -203,8 +418,9 @@ class Board:
         # Return the distance between two units. Here, distance is defined as the minimal number of steps needed to
         # reach one unit from the other, taking into account that units can move one tile in any direction (including
         # diagonally) and that the board_matrix wraps around (so it may be shorter to go from the other side).
-        loc1 = unit1.loc
-        loc2 = unit2.loc
+        return self.distance_between_locs(unit1.loc, unit2.loc)
+
+    def distance_between_locs(self, loc1, loc2):
         xdist_abs = abs(loc1[0] - loc2[0])
         xdist = min(xdist_abs, self.board_size[0] - xdist_abs)
         ydist_abs = abs(loc1[1] - loc2[1])
@@ -220,12 +436,23 @@ class Board:
     ####################################################################################################################
 
     def print_board(self):
-        # Print the board_matrix matrix nicely formatted
+        # Print the board_matrix matrix nicely formatted. Sparse boards are typically far too large to print whole, so
+        # only their occupied tiles are printed
+        if self.board_backend == "sparse":
+            self.print_occupied_tiles()
+            return
         # Code adapted from https://stackoverflow.com/questions/13214809/pretty-print-2d-python-list/32159502
-        output_mtx = [['X' if elem is None else elem.id for elem in row] for row in self.board_matrix.board_matrix]
+        output_mtx = [['X' if elem is None else elem.id for elem in row] for row in self.board_matrix.rows()]
         s = [[str(e) for e in row] for row in output_mtx]
         lens = [max(map(len, col)) for col in zip(*s)]
         fmt = '\t'.join('{{:{}}}'.format(x) for x in lens)
         table = [fmt.format(*row) for row in s]
         table_formatted = '\n'.join(table)
-        logger.log(20, table_formatted)
\ No newline at end of file
+        logger.log(20, table_formatted)
+
+    def print_occupied_tiles(self):
+        # Print the id of the unit on each occupied tile, one line for each row of the board with any
+        rows = {}
+        for loc, t_unit in sorted(self.occupied_tiles(), key=lambda item: item[0]):
+            rows.setdefault(loc[0], []).append(str(loc[1]) + ": " + str(t_unit.id))
+        logger.log(20, '\n'.join("Row " + str(x) + "\t" + '\t'.join(tiles) for x, tiles in rows.items()))
\ No newline at end of file
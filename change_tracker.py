@@ -0,0 +1,75 @@
+from math import ceil
+
+
+class ChangeTracker:
+    # This class keeps track of the board tiles which units entered or left since a given point in time (e.g. the start
+    # of a round). It is used to check whether a sensor value read by a unit at that point is still the value the unit
+    # would read now, without having to read it again. Changes are bucketed in a coarse grid so that only the changes
+    # around a unit need to be examined.
+    CELL_SIZE = 8
+
+    def __init__(self, board):
+        self.board = board
+        self.num_cells = [ceil(board.board_size[0] / self.CELL_SIZE), ceil(board.board_size[1] / self.CELL_SIZE)]
+        self.cells = {}  # Cell index tuple -> list of (location, player_id, entered) changes in that cell, where
+        # entered tells whether the unit entered or left the tile
+        self.num_changes = 0
+        board.tile_change_listeners.append(self.on_tile_changed)
+
+    def on_tile_changed(self, loc, unit):
+        loc = (loc[0] % self.board.board_size[0], loc[1] % self.board.board_size[1])
+        cell = (loc[0] // self.CELL_SIZE, loc[1] // self.CELL_SIZE)
+        entered = self.board.get_unit_in_loc(loc) is unit  # Listeners are notified after the tile has changed
+        self.cells.setdefault(cell, []).append((loc, unit.player_id, entered))
+        self.num_changes += 1
+
+    def reset(self):
+        # Forget all changes, making the current board state the new reference point
+        self.cells = {}
+        self.num_changes = 0
+
+    def cells_in_range(self, center, dist, axis):
+        # Return the cell indices along one axis covering all tiles within dist of center, taking wrapping into account
+        size = self.board.board_size[axis]
+        if 2 * dist + 1 >= size:
+            return range(self.num_cells[axis])
+        low = (center - dist) % size
+        high = (center + dist) % size
+        if low <= high:
+            return range(low // self.CELL_SIZE, high // self.CELL_SIZE + 1)
+        return list(range(low // self.CELL_SIZE, self.num_cells[axis])) + list(range(0, high // self.CELL_SIZE + 1))
+
+    def change_within_distance(self, loc, dist, f_bool=lambda player_id, distance, entered: True):
+        # Check whether there was a change within dist of loc satisfying the boolean function, which is given the
+        # player of the unit which entered or left the tile, the distance of the tile from loc and whether it entered
+        if self.num_changes == 0:
+            return False
+        for cell_x in self.cells_in_range(loc[0] % self.board.board_size[0], dist, 0):
+            for cell_y in self.cells_in_range(loc[1] % self.board.board_size[1], dist, 1):
+                for changed_loc, player_id, entered in self.cells.get((cell_x, cell_y), ()):
+                    distance = self.board.distance_between_locs(loc, changed_loc)
+                    if distance <= dist and f_bool(player_id, distance, entered):
+                        return True
+        return False
+
+    def read_is_valid(self, unit, sensor, value):
+        # Check whether reading the given sensor for the unit would still return value. Adjacency sensors can only
+        # change if a unit entered or left a neighbouring tile. The distance to the closest ally (enemy) can only change
+        # if an ally (enemy) entered a tile closer than that, or left a tile exactly that far away (it may have been the
+        # closest one): a unit appearing as far or further away is not closer, and a unit disappearing further away was
+        # not the closest one. The remaining sensors are not affected by the positions of other units.
+        if sensor == "num_adjacent_allies" or sensor == "num_adjacent_enemies":
+            return not self.change_within_distance(unit.loc, 1)
+        if sensor == "distance_from_closest_ally":
+            return not self.change_within_distance(
+                unit.loc, value, lambda player_id, distance, entered:
+                player_id == unit.player_id and (distance < value if entered else distance == value))
+        if sensor == "distance_from_closest_enemy":
+            return not self.change_within_distance(
+                unit.loc, value, lambda player_id, distance, entered:
+                player_id != unit.player_id and (distance < value if entered else distance == value))
+        if sensor == "num_total_allies":
+            return self.board.num_total_allies(unit.player_id) == value
+        if sensor == "num_total_enemies":
+            return self.board.num_total_enemies(unit.player_id) == value
+        return True
@@ -6,6 +6,19 @@ import logging
 logger = logging.getLogger(__name__)
 logger.setLevel(1)
 
+# Cost of each command, counted against the per-turn instruction budget of a unit if there is one. Sensors which query
+# the board cost more than arithmetic, the more so the more of the board they look at. Commands not listed here cost
+# DEFAULT_COMMAND_COST
+DEFAULT_COMMAND_COST = 1
+COMMAND_COSTS = {
+    "num_total_allies": 2,
+    "num_total_enemies": 2,
+    "num_adjacent_allies": 4,
+    "num_adjacent_enemies": 4,
+    "distance_from_closest_ally": 8,
+    "distance_from_closest_enemy": 8,
+}
+
 
 def critical_action(func):
     # Decorator for "critical actions", which can only be executed once per turn and only if the unit is able
@@ -16,7 +29,10 @@ def critical_action(func):
                 or self.turn_handler.current_unit().can_act() is False:
             return None
         self.turn_handler.performed_critical_action = True
+        if self.board.event_recorder is not None:
+            self.board.event_recorder.record_command(self.turn_handler.current_unit(), func.__name__)
         return func(self, *args, **kwargs)
+    decorated.is_critical = True  # Allows telling critical actions apart from other commands
     return decorated
 
 
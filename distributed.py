@@ -0,0 +1,317 @@
+from collections import deque
+import socketserver
+import threading
+import interpreter
+import itertools
+import argparse
+import logging
+import socket
+import struct
+import json
+import sys
+import game
+
+# Setup logging
+logger = logging.getLogger(__name__)
+logger.setLevel(1)
+
+# PROTOCOL
+# Every message is a frame made of a header (payload length as a 4-byte unsigned integer and message type as a 1-byte
+# unsigned integer, both big-endian) followed by the payload, which is UTF-8 encoded JSON.
+HEADER = struct.Struct(">IB")
+MSG_BATCH = 1  # Coordinator -> worker: {"scripts": [script texts], "jobs": [[job_id, [script indices], config, seed]]}
+MSG_RESULT = 2  # Worker -> coordinator, one per job as soon as it finishes: [job_id, winners, units per player, turns]
+# or [job_id, None, error message] if the game failed
+MSG_SHUTDOWN = 3  # Coordinator -> worker: the coordinator is done with this connection
+
+# DEFAULT PARAMETERS
+BATCH_SIZE = 4
+MAX_RETRIES = 3  # Number of times a job is retried after the worker running it dies
+RESULT_TIMEOUT = 600  # Seconds to wait for a result before considering a worker dead
+
+
+def send_message(sock, msg_type, payload):
+    data = json.dumps(payload, separators=(',', ':')).encode('utf-8')
+    sock.sendall(HEADER.pack(len(data), msg_type) + data)
+
+
+def recv_exact(sock, num_bytes):
+    data = b""
+    while len(data) < num_bytes:
+        chunk = sock.recv(num_bytes - len(data))
+        if not chunk:
+            raise ConnectionError("Connection closed")
+        data += chunk
+    return data
+
+
+def recv_message(sock):
+    length, msg_type = HEADER.unpack(recv_exact(sock, HEADER.size))
+    return msg_type, json.loads(recv_exact(sock, length).decode('utf-8'))
+
+
+########################################################################################################################
+# Worker
+########################################################################################################################
+
+class MatchRunner:
+    # Plays headless games, sharing a single interpreter between them so that scripts are only analyzed once. Games
+    # are played one at a time, since the interpreter can only be attached to one game at once
+    def __init__(self):
+        self.interpreter = interpreter.Interpreter(None, None)
+        self.lock = threading.Lock()
+
+    def run_job(self, job_id, scripts, config, seed):
+        try:
+            with self.lock:
+                g = game.Game(scripts=scripts, shared_interpreter=self.interpreter, headless=True, seed=seed, **config)
+                g.start_game()
+        except Exception as exception:
+            return [job_id, None, str(exception)]
+        winners = g.get_winners()[0]
+        units = [g.players[player_id].num_units() if player_id in g.players else 0
+                 for player_id in range(1, len(scripts) + 1)]
+        return [job_id, winners, units, g.turn_handler.turn_number]
+
+
+class WorkerHandler(socketserver.BaseRequestHandler):
+    # Serves a coordinator connection: runs every batch received, streaming back each result as soon as it is ready
+    def handle(self):
+        runner = self.server.runner
+        try:
+            while True:
+                msg_type, payload = recv_message(self.request)
+                if msg_type == MSG_SHUTDOWN:
+                    return
+                if msg_type != MSG_BATCH:
+                    raise Exception("Unexpected message type " + str(msg_type))
+                scripts = payload["scripts"]
+                for job_id, script_indices, config, seed in payload["jobs"]:
+                    result = runner.run_job(job_id, [scripts[idx] for idx in script_indices], config, seed)
+                    send_message(self.request, MSG_RESULT, result)
+        except ConnectionError:
+            return
+
+
+class WorkerServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address):
+        super().__init__(address, WorkerHandler)
+        self.runner = MatchRunner()
+
+
+def run_worker(host, port):
+    logging.disable(logging.CRITICAL)  # Games are headless; results are sent to the coordinator
+    with WorkerServer((host, port)) as server:
+        server.serve_forever()
+
+
+########################################################################################################################
+# Coordinator
+########################################################################################################################
+
+class Coordinator:
+    # Distributes jobs among workers and collects their results. Each worker has its own queue of jobs, which it
+    # takes batches from; a worker whose queue runs out steals half of the remaining jobs of the most loaded worker.
+    # If a worker dies, the jobs it had not finished are given back to the remaining workers, up to a number of retries.
+    def __init__(self, worker_addresses, batch_size=BATCH_SIZE, max_retries=MAX_RETRIES, timeout=RESULT_TIMEOUT):
+        self.worker_addresses = worker_addresses
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.lock = threading.Condition()
+        self.queues = []
+        self.jobs = {}
+        self.results = {}  # Job id -> result
+        self.failures = {}  # Job id -> error message
+        self.retries = {}  # Job id -> number of times the worker running it died
+        self.dead_workers = set()
+
+    def run(self, jobs):
+        # Run all jobs, given as (scripts, config, seed) tuples, returning the results and the failures by job index
+        self.jobs = dict(enumerate(jobs))
+        self.results = {}
+        self.failures = {}
+        self.retries = {job_id: 0 for job_id in self.jobs}
+        self.queues = [deque() for _ in self.worker_addresses]
+        for job_id in self.jobs:
+            self.queues[job_id % len(self.queues)].append(job_id)
+        self.dead_workers = set()
+
+        threads = [threading.Thread(target=self.serve_worker, args=(idx, address), daemon=True)
+                   for idx, address in enumerate(self.worker_addresses)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for job_id in self.jobs:
+            if job_id not in self.results and job_id not in self.failures:
+                self.failures[job_id] = "No workers left"
+        return self.results, self.failures
+
+    def finished(self):
+        return len(self.results) + len(self.failures) == len(self.jobs)
+
+    def take_batch(self, idx):
+        # Take the next batch for worker idx from its own queue, stealing from the most loaded queue if it is empty.
+        # Waits while other workers still have jobs in flight (they may give them back if they die). Returns None
+        # once there is nothing left to do.
+        with self.lock:
+            while True:
+                if self.finished():
+                    return None
+                if not self.queues[idx]:
+                    victim = max(self.queues, key=len)
+                    for _ in range((len(victim) + 1) // 2):
+                        self.queues[idx].appendleft(victim.pop())
+                if self.queues[idx]:
+                    return [self.queues[idx].popleft()
+                            for _ in range(min(self.batch_size, len(self.queues[idx])))]
+                self.lock.wait(1)
+
+    def give_back(self, idx, job_ids, error):
+        # Return the jobs of a dead worker to the queues of the remaining workers. Jobs it was running count as a retry
+        with self.lock:
+            self.dead_workers.add(idx)
+            alive = [queue for queue_idx, queue in enumerate(self.queues) if queue_idx not in self.dead_workers]
+            queued = list(self.queues[idx])
+            self.queues[idx].clear()
+            for job_id in job_ids:
+                self.retries[job_id] += 1
+            for job_id in job_ids + queued:
+                if job_id in self.results or job_id in self.failures:
+                    continue
+                if not alive:
+                    self.failures[job_id] = "No workers left (last error: " + error + ")"
+                elif self.retries[job_id] > self.max_retries:
+                    self.failures[job_id] = "Worker failed " + str(self.retries[job_id]) + " times: " + error
+                else:
+                    min(alive, key=len).append(job_id)
+            self.lock.notify_all()
+
+    def encode_batch(self, job_ids):
+        # Send each distinct script only once per batch
+        scripts = []
+        script_indices = {}
+        jobs = []
+        for job_id in job_ids:
+            job_scripts, config, seed = self.jobs[job_id]
+            indices = []
+            for script in job_scripts:
+                if script not in script_indices:
+                    script_indices[script] = len(scripts)
+                    scripts.append(script)
+                indices.append(script_indices[script])
+            jobs.append([job_id, indices, config, seed])
+        return {"scripts": scripts, "jobs": jobs}
+
+    def serve_worker(self, idx, address):
+        pending = []
+        try:
+            with socket.create_connection(address, timeout=self.timeout) as sock:
+                while True:
+                    pending = self.take_batch(idx)
+                    if pending is None:
+                        send_message(sock, MSG_SHUTDOWN, None)
+                        return
+                    send_message(sock, MSG_BATCH, self.encode_batch(pending))
+                    for _ in range(len(pending)):
+                        msg_type, result = recv_message(sock)
+                        if msg_type != MSG_RESULT:
+                            raise ConnectionError("Unexpected message type " + str(msg_type))
+                        with self.lock:
+                            job_id = result[0]
+                            if result[1] is None:
+                                self.failures[job_id] = result[2]
+                            else:
+                                self.results[job_id] = result[1:]
+                            pending.remove(job_id)
+                            self.lock.notify_all()
+        except (OSError, ConnectionError) as exception:
+            logger.log(30, "Worker " + address[0] + ":" + str(address[1]) + " failed: " + str(exception))
+            self.give_back(idx, pending or [], str(exception))
+
+
+########################################################################################################################
+# Ladder
+########################################################################################################################
+
+def ladder_jobs(scripts, games_per_pair, config, seed=0):
+    # Every pair of scripts plays the given number of games, alternating which script moves first
+    jobs = []
+    for first, second in itertools.combinations(range(len(scripts)), 2):
+        for game_idx in range(games_per_pair):
+            pair = [first, second] if game_idx % 2 == 0 else [second, first]
+            jobs.append((pair, [scripts[idx] for idx in pair], config, seed + game_idx))
+    return jobs
+
+
+def aggregate(jobs, results, num_scripts):
+    # Sum up, for every script, the number of games played and won (ties count as a fraction of a win) and the units
+    # remaining at the end of its games
+    totals = [{"games": 0, "wins": 0.0, "units": 0} for _ in range(num_scripts)]
+    for job_id, (winners, units, _) in results.items():
+        participants = jobs[job_id][0]
+        for player_idx, script_idx in enumerate(participants):
+            totals[script_idx]["games"] += 1
+            totals[script_idx]["units"] += units[player_idx]
+            if player_idx + 1 in winners:
+                totals[script_idx]["wins"] += 1 / len(winners)
+    return totals
+
+
+def parse_address(address):
+    host, port = address.rsplit(":", 1)
+    return host, int(port)
+
+
+def main():
+    # Argument parsing
+    parser = argparse.ArgumentParser(description="Run matches on workers over TCP")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    worker_parser = subparsers.add_parser("worker", help="Start a worker")
+    worker_parser.add_argument('-p', '--port', type=int, required=True,
+                               help='Port to listen on. By default only local connections are accepted (see --host)')
+    worker_parser.add_argument('--host', default="127.0.0.1",
+                               help='Address to listen on (default: 127.0.0.1, i.e. local connections only; '
+                                    'use 0.0.0.0 to accept connections from other machines)')
+
+    run_parser = subparsers.add_parser("run", help="Play a ladder between scripts on the given workers")
+    run_parser.add_argument('-w', '--workers', nargs='+', required=True, help='Worker addresses, as host:port')
+    run_parser.add_argument('-f', '--filepaths', nargs='+', required=True, help='Filepaths for bot strategy scripts')
+    run_parser.add_argument('-g', '--games', type=int, default=10, help='Number of games for each pair of scripts')
+    run_parser.add_argument('--config', type=json.loads, default={}, help='Game parameters as JSON')
+    run_parser.add_argument('-s', '--seed', type=int, default=0, help='Seed of the first game of each pair')
+    run_parser.add_argument('-b', '--batch-size', type=int, default=BATCH_SIZE, help='Jobs sent to a worker at once')
+    args = parser.parse_args()
+
+    if args.command == "worker":
+        run_worker(args.host, args.port)
+        return
+
+    logging.basicConfig(format='%(message)s')
+    scripts = []
+    for path in args.filepaths:
+        with open(path, 'r') as input_file:
+            scripts.append(input_file.read())
+    jobs = ladder_jobs(scripts, args.games, args.config, args.seed)
+    coordinator = Coordinator([parse_address(address) for address in args.workers], args.batch_size)
+    results, failures = coordinator.run([job[1:] for job in jobs])
+
+    totals = aggregate(jobs, results, len(scripts))
+    for path, script_totals in sorted(zip(args.filepaths, totals), key=lambda item: -item[1]["wins"]):
+        print(path.ljust(40) + ("%.1f wins" % script_totals["wins"]).rjust(12)
+              + (" / " + str(script_totals["games"]) + " games").ljust(14)
+              + ("%.1f units on average" % (script_totals["units"] / max(script_totals["games"], 1))).rjust(24))
+    if failures:
+        print(str(len(failures)) + " game(s) failed:")
+        for job_id, error in sorted(failures.items()):
+            print("  game " + str(job_id) + ": " + error)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,216 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from script_generator import ScriptGenerator, render_script, uses_defined_symbols
+import argparse
+import logging
+import random
+import json
+import sys
+import game
+
+# Loggers whose messages make up the event stream of a game. Other loggers (e.g. execution statistics of a particular
+# engine configuration) are not part of the game's behaviour
+ENGINE_LOGGERS = ["game", "board", "unit", "cmd"]
+
+# DEFAULT CAMPAIGN PARAMETERS
+TURN_LIMIT = 300
+MAX_PLAYERS = 4
+BOARD_SIZES = [4, 16]  # Smallest and largest board size; small boards make units interact early and often. Larger
+# boards (e.g. 40 to 100, with a few thousand turns) are needed to exercise the chunked searches of the sparse board
+# and the change tracking of the speculative and batched execution modes
+
+
+class EventCapture(logging.Handler):
+    # Logging handler collecting the messages logged by the engine
+    def __init__(self):
+        super().__init__(level=1)
+        self.messages = []
+
+    def emit(self, record):
+        if record.name in ENGINE_LOGGERS:
+            self.messages.append(record.getMessage())
+
+
+_capture = None  # EventCapture of the current process
+
+
+def install_capture():
+    global _capture
+    if _capture is None:
+        _capture = EventCapture()
+        root_logger = logging.getLogger()
+        root_logger.setLevel(1)
+        root_logger.addHandler(_capture)
+
+
+def generate_case(seed, turn_limit=TURN_LIMIT, max_players=MAX_PLAYERS, board_sizes=BOARD_SIZES):
+    # Generate a random game: a random number of players with random scripts, on a random board
+    rng = random.Random(seed)
+    generator = ScriptGenerator(rng)
+    size = rng.randint(board_sizes[0], board_sizes[1])
+    return {"seed": seed, "board_size": [size, size], "unit_limit_pct": rng.choice([0.05, 0.2, 0.5]),
+            "turn_limit": turn_limit,
+            "scripts": [generator.script() for _ in range(rng.randint(2, max_players))]}
+
+
+def board_state(g):
+    # Everything about the units that may affect the rest of the game
+    size = g.board.board_size
+    return sorted((t_unit.id, t_unit.player_id, t_unit.loc[0] % size[0], t_unit.loc[1] % size[1], t_unit.hp,
+                   t_unit.spawn_timer, t_unit.charge_timer, t_unit.defending, repr(sorted(t_unit.var_data.items())))
+                  for player_r in g.players.values() for t_unit in player_r.units)
+
+
+def run_engine(case, config):
+    # Play the case's game with the given engine configuration, returning the event stream: for every turn, the
+    # messages logged and the state of the board after the turn, followed by the messages logged after the last turn
+    # and the error which ended the game, if any
+    install_capture()
+    _capture.messages = []
+    events = []
+    params = {"board_size": case["board_size"], "unit_limit_pct": case["unit_limit_pct"],
+              "turn_limit": case["turn_limit"], "seed": case["seed"], "headless": True}
+    params.update(config)
+    g = game.Game(scripts=[render_script(statements) for statements in case["scripts"]], **params)
+    turn = g.turn
+
+    def traced_turn():
+        turn()
+        events.append((g.turn_handler.turn_number, _capture.messages, board_state(g)))
+        _capture.messages = []
+
+    g.turn = traced_turn
+    try:
+        g.start_game()
+        error = None
+    except Exception as exception:
+        error = "Error: " + str(exception)
+    events.append(("end", _capture.messages, error))
+    return events
+
+
+def find_divergence(case, reference, candidate):
+    # Run the case under both engine configurations and compare their event streams turn by turn. Returns None if they
+    # are identical, or the first differing events otherwise
+    reference_events = run_engine(case, reference)
+    candidate_events = run_engine(case, candidate)
+    for idx in range(max(len(reference_events), len(candidate_events))):
+        reference_event = reference_events[idx] if idx < len(reference_events) else None
+        candidate_event = candidate_events[idx] if idx < len(candidate_events) else None
+        if reference_event != candidate_event:
+            return {"turn": idx + 1, "reference": reference_event, "candidate": candidate_event}
+    return None
+
+
+def check_seed(seed, reference, candidate, turn_limit, board_sizes):
+    case = generate_case(seed, turn_limit, board_sizes=board_sizes)
+    return case, find_divergence(case, reference, candidate)
+
+
+########################################################################################################################
+# Minimization
+########################################################################################################################
+
+def statement_reductions(statements):
+    # Yield simpler versions of a script: with one statement removed, or with an if statement replaced by the
+    # statements of one of its branches
+    for idx, statement in enumerate(statements):
+        yield statements[:idx] + statements[idx + 1:]
+        if isinstance(statement, tuple) and statement[0] in ["if", "if_else"]:
+            for branch in statement[1][1:]:
+                yield statements[:idx] + branch + statements[idx + 1:]
+
+
+def case_reductions(case):
+    # Yield simpler versions of a case: with a player removed, or with a simpler script for one of the players. Scripts
+    # reading a symbol which is no longer defined are skipped, since they fail regardless of the engine
+    if len(case["scripts"]) > 2:
+        for idx in range(len(case["scripts"])):
+            yield dict(case, scripts=case["scripts"][:idx] + case["scripts"][idx + 1:])
+    for idx, statements in enumerate(case["scripts"]):
+        for reduced in statement_reductions(statements):
+            if reduced and uses_defined_symbols(reduced):
+                yield dict(case, scripts=case["scripts"][:idx] + [reduced] + case["scripts"][idx + 1:])
+
+
+def minimize(case, divergence, reference, candidate):
+    # Greedily simplify a diverging case for as long as it keeps diverging. The turn limit is first cut down to the
+    # turn of the divergence, since nothing after it is needed to reproduce it
+    case = dict(case, turn_limit=divergence["turn"])
+    progress = True
+    while progress:
+        progress = False
+        for reduced in case_reductions(case):
+            reduced_divergence = find_divergence(reduced, reference, candidate)
+            if reduced_divergence is not None:
+                case = dict(reduced, turn_limit=min(reduced["turn_limit"], reduced_divergence["turn"]))
+                divergence = reduced_divergence
+                progress = True
+                break
+    return case, divergence
+
+
+########################################################################################################################
+# Campaign
+########################################################################################################################
+
+def run_campaign(num_cases, start_seed, reference, candidate, turn_limit, jobs, board_sizes=BOARD_SIZES):
+    # Check cases in parallel, stopping at the first divergence found. Returns the number of cases checked, and the
+    # diverging case and divergence (or None, None)
+    num_checked = 0
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = [pool.submit(check_seed, seed, reference, candidate, turn_limit, board_sizes)
+                   for seed in range(start_seed, start_seed + num_cases)]
+        for future in as_completed(futures):
+            case, divergence = future.result()
+            num_checked += 1
+            if divergence is not None:
+                pool.shutdown(cancel_futures=True)
+                return num_checked, case, divergence
+            if num_checked % 100 == 0:
+                print(str(num_checked) + " cases checked")
+                sys.stdout.flush()
+    return num_checked, None, None
+
+
+def reproducer(case, divergence, reference, candidate):
+    return {"reference": reference, "candidate": candidate,
+            "case": dict(case, scripts=[render_script(statements) for statements in case["scripts"]]),
+            "divergence": divergence}
+
+
+def main():
+    # Argument parsing
+    parser = argparse.ArgumentParser(description="Check that two engine configurations play random games identically")
+    parser.add_argument('-n', '--cases', type=int, default=1000, help='Number of random games to check')
+    parser.add_argument('--start-seed', type=int, default=0, help='Seed of the first game')
+    parser.add_argument('--reference', type=json.loads, default={},
+                        help='Game parameters of the reference engine, as JSON')
+    parser.add_argument('--candidate', type=json.loads, default={"execution_mode": "speculative", "num_workers": 2},
+                        help='Game parameters of the engine checked against the reference, as JSON')
+    parser.add_argument('--turns', type=int, default=TURN_LIMIT, help='Turn limit of each game')
+    parser.add_argument('--board-sizes', type=int, nargs=2, default=BOARD_SIZES, metavar=('MIN', 'MAX'),
+                        help='Range of board sizes (the board is size x size)')
+    parser.add_argument('-j', '--jobs', type=int, help='Number of games checked at once (default: number of CPUs)')
+    parser.add_argument('-o', '--output', default="divergence.json", help='Path for the minimised reproducer')
+    args = parser.parse_args()
+
+    num_checked, case, divergence = run_campaign(args.cases, args.start_seed, args.reference, args.candidate,
+                                                 args.turns, args.jobs, args.board_sizes)
+    if divergence is None:
+        print("No divergence found in " + str(num_checked) + " cases")
+        return
+
+    print("Divergence found in case with seed " + str(case["seed"]) + " at turn " + str(divergence["turn"])
+          + ", minimising...")
+    case, divergence = minimize(case, divergence, args.reference, args.candidate)
+    with open(args.output, 'w') as output_file:
+        json.dump(reproducer(case, divergence, args.reference, args.candidate), output_file, indent=2)
+    for idx, statements in enumerate(case["scripts"]):
+        print("Player " + str(idx + 1) + " script:\n" + render_script(statements))
+    print("Diverges at turn " + str(divergence["turn"]) + "\nReference: " + str(divergence["reference"])
+          + "\nCandidate: " + str(divergence["candidate"]) + "\nReproducer written to " + args.output)
+    sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,313 @@
+from concurrent.futures import ProcessPoolExecutor
+from script_generator import ScriptGenerator, parse_script, render_script, uses_defined_symbols
+import interpreter
+import argparse
+import hashlib
+import logging
+import random
+import copy
+import json
+import time
+import sys
+import os
+import game
+
+# DEFAULT SEARCH PARAMETERS
+POPULATION_SIZE = 40
+NUM_ELITES = 4  # Best candidates carried over unchanged to the next generation
+TOURNAMENT_SIZE = 3
+CROSSOVER_RATE = 0.5
+GAMES_PER_OPPONENT = 4
+BOARD_SIZE = [20, 20]
+TURN_LIMIT = 2000
+MAX_SCRIPT_LENGTH = 2000  # Longer candidates are rejected, to keep scripts from bloating
+MAX_MUTATION_ATTEMPTS = 20
+STRATEGIES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "strategies")
+
+
+def script_hash(script):
+    return hashlib.sha1(script.encode('utf-8')).hexdigest()
+
+
+########################################################################################################################
+# Fitness evaluation
+########################################################################################################################
+
+class FitnessEvaluator:
+    # Plays candidate scripts against the reference pool. One evaluator is kept in each worker process, sharing a
+    # single interpreter between all games so that the opponents' scripts are only analyzed once per process.
+    def __init__(self, opponents, games_per_opponent, board_size, turn_limit):
+        self.opponents = opponents
+        self.games_per_opponent = games_per_opponent
+        self.board_size = board_size
+        self.turn_limit = turn_limit
+        self.interpreter = interpreter.Interpreter(None, None)
+
+    def play(self, scripts, seed):
+        g = game.Game(scripts=scripts, shared_interpreter=self.interpreter, headless=True,
+                      board_size=list(self.board_size), turn_limit=self.turn_limit, seed=seed)
+        g.start_game()
+        return g.get_winners()[0]
+
+    def evaluate(self, script):
+        # Return the fraction of games won by the script (ties count as a fraction of a win). Every candidate plays the
+        # same seeds, and the candidate alternates between moving first and second. A script which fails loses.
+        score = 0
+        for opponent_idx, opponent in enumerate(self.opponents):
+            for game_idx in range(self.games_per_opponent):
+                candidate_id = 1 + game_idx % 2
+                scripts = [script, opponent] if candidate_id == 1 else [opponent, script]
+                try:
+                    winners = self.play(scripts, opponent_idx * self.games_per_opponent + game_idx)
+                except Exception:
+                    winners = []
+                if candidate_id in winners:
+                    score += 1 / len(winners)
+        self.interpreter.analyzed_scripts.pop(script, None)  # Candidates are only evaluated once
+        return score / (len(self.opponents) * self.games_per_opponent)
+
+
+_evaluator = None  # FitnessEvaluator of the current worker process
+
+
+def init_worker(opponents, games_per_opponent, board_size, turn_limit):
+    global _evaluator
+    logging.disable(logging.CRITICAL)
+    _evaluator = FitnessEvaluator(opponents, games_per_opponent, board_size, turn_limit)
+
+
+def evaluate_script(script):
+    return _evaluator.evaluate(script)
+
+
+########################################################################################################################
+# Genetic operators
+########################################################################################################################
+
+def collect_slots(statements):
+    # Return all places in a script where a node may be replaced, as (container, index, kind) tuples. Statements are
+    # items of blocks, and expressions are arguments of commands. Arguments which must stay as they are (the symbol
+    # being defined, the divisor, and the number of turns to charge) are not included.
+    slots = []
+
+    def visit_block(block):
+        for idx, node in enumerate(block):
+            slots.append((block, idx, "statement"))
+            visit_node(node)
+
+    def visit_node(node):
+        if not isinstance(node, tuple):
+            return
+        name, args = node
+        for idx, arg in enumerate(args):
+            if isinstance(arg, list):
+                visit_block(arg)
+            elif not ((name == "define" and idx == 0) or (name == "div" and idx == 1) or name == "charge_attack"):
+                slots.append((args, idx, "expression"))
+                visit_node(arg)
+
+    visit_block(statements)
+    return slots
+
+
+def defined_symbols(statements):
+    # All symbols defined anywhere in the script
+    symbols = []
+
+    def visit(node):
+        if isinstance(node, list):
+            for item in node:
+                visit(item)
+        elif isinstance(node, tuple):
+            name, args = node
+            if name == "define" and args[0] not in symbols:
+                symbols.append(args[0])
+            visit(args)
+
+    visit(statements)
+    return symbols
+
+
+def is_valid(statements):
+    return len(statements) > 0 and uses_defined_symbols(statements) \
+        and len(render_script(statements)) <= MAX_SCRIPT_LENGTH
+
+
+def mutate(statements, rng):
+    # Return a mutated copy of the script: a statement or expression replaced by a random one, a statement inserted or
+    # deleted, or a number changed. Mutations which would read undefined symbols are retried.
+    generator = ScriptGenerator(rng)
+    for _ in range(MAX_MUTATION_ATTEMPTS):
+        mutated = copy.deepcopy(statements)
+        symbols = defined_symbols(mutated)
+        slots = collect_slots(mutated)
+        container, idx, kind = rng.choice(slots)
+        mutation = rng.choice(["replace", "replace", "insert", "delete", "number"])
+        if mutation == "replace" and kind == "statement":
+            container[idx] = generator.statement(symbols, 1)
+        elif mutation == "replace":
+            container[idx] = generator.expression(symbols, 2)
+        elif mutation == "insert":
+            block = container if kind == "statement" else mutated
+            block.insert(rng.randint(0, len(block)), generator.statement(symbols, 1))
+        elif mutation == "delete" and kind == "statement" and len(container) > 1:
+            del container[idx]
+        elif mutation == "number" and isinstance(container[idx], (int, float)) and kind == "expression":
+            container[idx] = max(0, container[idx] + rng.choice([-2, -1, 1, 2]))
+        else:
+            continue
+        if is_valid(mutated):
+            return mutated
+    return copy.deepcopy(statements)
+
+
+def crossover(first, second, rng):
+    # One-point crossover of the top-level statements of two scripts
+    for _ in range(MAX_MUTATION_ATTEMPTS):
+        child = copy.deepcopy(first[:rng.randint(0, len(first))] + second[rng.randint(0, len(second) - 1):])
+        if is_valid(child):
+            return child
+    return copy.deepcopy(first)
+
+
+########################################################################################################################
+# Search
+########################################################################################################################
+
+class EvolutionarySearch:
+    # Evolves a population of scripts, scoring each one by playing it against a pool of reference scripts. Fitness is
+    # memoised by script hash, so candidates seen before (e.g. elites, or identical offspring) are never re-evaluated,
+    # and the population is checkpointed to disk after every generation.
+    def __init__(self, seed_scripts, opponents, population_size=POPULATION_SIZE, games_per_opponent=GAMES_PER_OPPONENT,
+                 board_size=BOARD_SIZE, turn_limit=TURN_LIMIT, jobs=None, checkpoint_path=None, seed=0):
+        self.seed_scripts = seed_scripts
+        self.population_size = population_size
+        self.checkpoint_path = checkpoint_path
+        self.seed = seed
+        self.generation = 0
+        self.population = []  # Script trees
+        self.fitness_cache = {}  # Script hash -> fitness
+        self.pool = ProcessPoolExecutor(max_workers=jobs, initializer=init_worker,
+                                        initargs=(opponents, games_per_opponent, board_size, turn_limit))
+        self.jobs = jobs or os.cpu_count()
+
+    def initial_population(self):
+        rng = random.Random(self.seed)
+        generator = ScriptGenerator(rng)
+        population = [parse_script(script) for script in self.seed_scripts]
+        while len(population) < self.population_size:
+            population.append(generator.script())
+        return population[:self.population_size]
+
+    def evaluate(self, population):
+        # Return the fitness of each script, evaluating the ones not seen before in parallel
+        scripts = [render_script(statements) for statements in population]
+        new_scripts = list({script_hash(script): script for script in scripts
+                            if script_hash(script) not in self.fitness_cache}.values())
+        start = time.perf_counter()
+        chunksize = max(1, len(new_scripts) // (4 * self.jobs))
+        for script, fitness in zip(new_scripts, self.pool.map(evaluate_script, new_scripts, chunksize=chunksize)):
+            self.fitness_cache[script_hash(script)] = fitness
+        elapsed = time.perf_counter() - start
+        return [self.fitness_cache[script_hash(script)] for script in scripts], len(new_scripts), elapsed
+
+    def select(self, scored, rng):
+        # Tournament selection
+        return max(rng.sample(scored, min(TOURNAMENT_SIZE, len(scored))), key=lambda item: item[0])[1]
+
+    def next_generation(self, scored, rng):
+        scored = sorted(scored, key=lambda item: item[0], reverse=True)
+        population = [statements for _, statements in scored[:NUM_ELITES]]
+        while len(population) < self.population_size:
+            if rng.random() < CROSSOVER_RATE:
+                child = crossover(self.select(scored, rng), self.select(scored, rng), rng)
+            else:
+                child = self.select(scored, rng)
+            population.append(mutate(child, rng))
+        return population
+
+    def run(self, num_generations):
+        if not self.population:
+            self.population = self.initial_population()
+        best = None
+        while self.generation < num_generations:
+            fitnesses, num_evaluated, elapsed = self.evaluate(self.population)
+            scored = list(zip(fitnesses, self.population))
+            best = max(scored, key=lambda item: item[0])
+            print("Generation " + str(self.generation) + ": best fitness " + "%.3f" % best[0]
+                  + ", mean " + "%.3f" % (sum(fitnesses) / len(fitnesses)) + ", " + str(num_evaluated)
+                  + " evaluations (" + str(len(fitnesses) - num_evaluated) + " cached) in " + "%.2f" % elapsed + "s"
+                  + (" = %.2f evaluations/s" % (num_evaluated / elapsed) if num_evaluated else ""))
+            sys.stdout.flush()
+
+            # Each generation has its own random number generator, so resuming from a checkpoint is deterministic
+            self.population = self.next_generation(scored, random.Random(self.seed * 100003 + self.generation))
+            self.generation += 1
+            self.save_checkpoint(best)
+        return best
+
+    def save_checkpoint(self, best):
+        if self.checkpoint_path is None:
+            return
+        checkpoint = {"generation": self.generation, "seed": self.seed,
+                      "population": [render_script(statements) for statements in self.population],
+                      "best": {"script": render_script(best[1]), "fitness": best[0]},
+                      "fitness_cache": self.fitness_cache}
+        # Write to a temporary file first, so an interrupted write does not destroy the previous checkpoint
+        with open(self.checkpoint_path + ".tmp", 'w') as output_file:
+            json.dump(checkpoint, output_file)
+        os.replace(self.checkpoint_path + ".tmp", self.checkpoint_path)
+
+    def load_checkpoint(self):
+        with open(self.checkpoint_path, 'r') as input_file:
+            checkpoint = json.load(input_file)
+        self.generation = checkpoint["generation"]
+        self.seed = checkpoint["seed"]
+        self.population = [parse_script(script) for script in checkpoint["population"]]
+        self.fitness_cache = checkpoint["fitness_cache"]
+
+    def shutdown(self):
+        self.pool.shutdown()
+
+
+def main():
+    # Argument parsing
+    parser = argparse.ArgumentParser(description="Search for strong strategies by evolving scripts")
+    parser.add_argument('-f', '--filepaths', nargs='*', default=[],
+                        help='Filepaths for scripts to include in the initial population')
+    parser.add_argument('--opponents', nargs='*', default=[os.path.join(STRATEGIES_DIR, "test1.txt"),
+                                                        os.path.join(STRATEGIES_DIR, "test2.txt")],
+                        help='Filepaths for the scripts candidates play against')
+    parser.add_argument('-g', '--generations', type=int, default=20, help='Number of generations')
+    parser.add_argument('-n', '--population', type=int, default=POPULATION_SIZE, help='Population size')
+    parser.add_argument('--games', type=int, default=GAMES_PER_OPPONENT, help='Games against each opponent')
+    parser.add_argument('--turns', type=int, default=TURN_LIMIT, help='Turn limit of each game')
+    parser.add_argument('-j', '--jobs', type=int, help='Number of worker processes (default: number of CPUs)')
+    parser.add_argument('-s', '--seed', type=int, default=0, help='Seed for the search')
+    parser.add_argument('-c', '--checkpoint', default="evolve_checkpoint.json", help='Path for the checkpoint')
+    parser.add_argument('-r', '--resume', action='store_true', help='Resume from the checkpoint')
+    parser.add_argument('-o', '--output', default="best_strategy.txt", help='Path for the best script found')
+    args = parser.parse_args()
+
+    def read(path):
+        with open(path, 'r') as input_file:
+            return input_file.read()
+
+    search = EvolutionarySearch([read(path) for path in args.filepaths], [read(path) for path in args.opponents],
+                                args.population, args.games, BOARD_SIZE, args.turns, args.jobs, args.checkpoint,
+                                args.seed)
+    if args.resume:
+        search.load_checkpoint()
+    try:
+        best = search.run(args.generations)
+    finally:
+        search.shutdown()
+    if best is None:
+        return
+    with open(args.output, 'w') as output_file:
+        output_file.write(render_script(best[1]) + "\n")
+    print("Best script (fitness " + "%.3f" % best[0] + ") written to " + args.output + ":\n" + render_script(best[1]))
+
+
+if __name__ == "__main__":
+    main()
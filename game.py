@@ -3,20 +3,34 @@ import board
 import turn_handler
 import player
 import cmd
+import renderer
+import speculative
+import batched
+import replay
 import argparse
 import logging
+import random
 
 # Setup logging
 logger = logging.getLogger(__name__)
 
 
 class Game:
-    def __init__(self, filepaths):
+    def __init__(self, filepaths=None, scripts=None, shared_interpreter=None, **config):
+        # Read player scripts from the filepaths, unless the scripts themselves are provided. A shared interpreter may
+        # be provided when playing many games in a row, in order to reuse the scripts it has already analyzed
+        if scripts is None:
+            scripts = []
+            for path in filepaths or []:
+                with open(path, 'r') as input_file:
+                    scripts.append(input_file.read())
+
         # Verify arguments
-        if len(filepaths) < 2:
+        if len(scripts) < 2:
             raise Exception("Game requires at least two players. "
                             "Provide a filepath for the script used for each player")
         self.strategy_filepaths = filepaths
+        self.strategy_scripts = scripts
 
         # DEFAULT PARAMETERS
         self.board_size = [20, 20]
@@ -26,17 +40,60 @@ class Game:
         # numbers and the board, and 10 to also display action messages
         self.write_to_file = True
         self.log_path = "log.txt"
+        self.display_mode = "log"  # How the board is displayed. "log" prints the full board through the logger every
+        # turn (at level 20). "terminal" draws it directly on the terminal, redrawing only the tiles that changed
+        self.render_max_fps = None  # Maximum number of frames per second drawn in terminal display mode
+        self.render_every_n_rounds = None  # If set, only draw the board in terminal display mode every N rounds
+        self.board_backend = "dense"  # How the board is stored. "dense" allocates every tile. "sparse" only stores the
+        # occupied tiles, so that memory scales with the number of units rather than the area, for very large boards
+        self.seed = None  # Seed for the random number generator, for reproducible games
+        self.execution_mode = "serial"  # How unit scripts are executed. "serial" runs each script on its unit's turn.
+        # "speculative" evaluates the scripts of a whole round in parallel worker processes. "batched" evaluates the
+        # leading sensor and arithmetic definitions of every script at the start of each round, in one pass per player.
+        # All modes give identical results
+        self.num_workers = None  # Number of worker processes in speculative execution mode (default: number of CPUs)
+        self.turn_budget = None  # If set, the maximum total cost of the commands a unit may execute in one turn (see
+        # cmd.COMMAND_COSTS). A script which runs out of budget simply ends its turn at that point
+        self.replay_path = None  # If set, the events of the game are recorded to a replay file at this path, for
+        # analysis with replay_query.py
+        self.headless = False  # If True, no log handlers are configured and the board is not displayed. Used when
+        # running many games in one process (e.g. benchmarks), which should set up logging themselves if needed
+
+        # Override default parameters with any provided ones
+        for param, value in config.items():
+            if not hasattr(self, param):
+                raise Exception("Unknown game parameter " + param)
+            setattr(self, param, value)
 
         # OBJECT INITIALIZATION
         self.players = {}  # Dict of players, player_id -> player_object
         self.turn_handler = turn_handler.TurnHandler()  # Turn handler in charge of determining which unit acts when
         self.board = board.Board(self.turn_handler, self.players,
-                                 self.board_size, self.unit_limit_pct)  # Board and units
+                                 self.board_size, self.unit_limit_pct, self.board_backend)  # Board and units
         self.user_commands = cmd.Commands(self.board, self.turn_handler)
-        self.interpreter = interpreter.Interpreter(self.turn_handler, self.user_commands)
+        if shared_interpreter is None:
+            self.interpreter = interpreter.Interpreter(self.turn_handler, self.user_commands)
+        else:
+            self.interpreter = shared_interpreter
+            self.interpreter.bind(self.turn_handler, self.user_commands)
+        self.board_renderer = None
+        if self.display_mode == "terminal":
+            self.board_renderer = renderer.TerminalRenderer(self.board, self.turn_handler,
+                                                            self.render_max_fps, self.render_every_n_rounds)
+        elif self.display_mode != "log":
+            raise Exception("Unknown display mode " + str(self.display_mode))
+        if self.execution_mode not in ["serial", "speculative", "batched"]:
+            raise Exception("Unknown execution mode " + str(self.execution_mode))
+        self.turn_handler.turn_budget = self.turn_budget
+        self.budget_stats = {}  # player_id -> instruction budget usage, if turns have a budget
+        self.round_executor = None  # Executes the scripts of each round ahead of the units' turns in the speculative
+        # and batched execution modes. Created when the game starts, once the player scripts are known
+        self.replay_recorder = None  # Created when the game starts
+        self.player_scripts = {}  # player_id -> script text
 
         # CONFIGURE LOGGER
-        self.configure_logger()
+        if not self.headless:
+            self.configure_logger()
 
     def configure_logger(self):
         # Configure the logger and its handlers
@@ -45,7 +102,10 @@ class Game:
 
         # Handler for stream output
         stream_handler = logging.StreamHandler()
-        stream_handler.setLevel(self.log_level)
+        if self.board_renderer is None:
+            stream_handler.setLevel(self.log_level)
+        else:
+            stream_handler.setLevel(max(self.log_level, 30))  # Other messages would scroll the drawn board away
         stream_handler.setFormatter(formatter)
         handlers.append(stream_handler)
 
@@ -59,22 +119,18 @@ class Game:
         logging.basicConfig(handlers=handlers, level=10)
 
     def populate_players(self):
-        # For each player, read their script and analyze it, and create a new player object
+        # For each player, analyze their script and create a new player object
         # with the resulting instructions
-        for idx, path in enumerate(self.strategy_filepaths):
-            with open(path, 'r') as input_file:
-                bot_cmds = input_file.read()
-            self.players[idx + 1] = player.Player(idx + 1, self.interpreter.analyze(bot_cmds))
+        for idx, bot_cmds in enumerate(self.strategy_scripts):
+            self.player_scripts[idx + 1] = bot_cmds
+            self.players[idx + 1] = player.Player(idx + 1, self.interpreter.analyze_script(bot_cmds))
 
     def spawn_initial_units(self):
-        # For each player, spawn one unit in a random location on the board_matrix. If the location has already
-        # been picked, keep picking random locations until an available one has been found.
-        spawn_locs = set()
-        newloc = self.board.get_random_location()
+        # For each player, spawn one unit in a random free location on the board_matrix
         for player_id in self.players:
-            while tuple(newloc) in spawn_locs:
-                newloc = self.board.get_random_location()
-            spawn_locs.add(tuple(newloc))
+            newloc = self.board.get_random_free_location()
+            if newloc is None:
+                raise Exception("Board is too small for " + str(len(self.players)) + " players")
             self.board.spawn_unit(player_id, newloc)
 
     def turn_limit_reached(self):
@@ -82,45 +138,90 @@ class Game:
 
     def turn(self):
         # Start turn (resetting all relevant state variables), execute script for current acting unit, and end turn
+        if self.round_executor is not None and self.turn_handler.round_starting():
+            self.round_executor.start_round()
         self.turn_handler.start_turn()
         logger.log(20, "Turn number " + str(self.interpreter.turn_handler.turn_number))
         logger.log(20, "Acting unit: " + str(self.interpreter.turn_handler.current_unit().id))
-        self.players[self.turn_handler.current_player()].command_script()
+        player_id = self.turn_handler.current_player()
+        if self.round_executor is None or not self.round_executor.execute_turn(self.turn_handler.current_unit()):
+            self.run_script(self.players[player_id].command_script)
+        if self.turn_budget is not None:
+            self.record_budget_usage(player_id)
         self.turn_handler.end_turn()
-        self.board.print_board()
+        self.display_board()
         self.remove_losing_players()
 
+    def run_script(self, script):
+        # Execute an analyzed script for the acting unit. If the unit runs out of instruction budget, its turn ends
+        try:
+            script()
+        except turn_handler.BudgetExhausted:
+            logger.log(10, "Unit " + str(self.turn_handler.current_unit().id) + " ran out of instruction budget")
+
+    def record_budget_usage(self, player_id):
+        if player_id not in self.budget_stats:
+            self.budget_stats[player_id] = {"used": 0, "turns": 0, "exhausted": 0}
+        stats = self.budget_stats[player_id]
+        stats["used"] += self.turn_handler.budget_used
+        stats["turns"] += 1
+        stats["exhausted"] += self.turn_handler.budget_exhausted
+
+    def report_budget_usage(self):
+        for player_id in sorted(self.budget_stats):
+            stats = self.budget_stats[player_id]
+            logger.log(30, "Player " + str(player_id) + " used " + str(stats["used"]) + " instruction budget in "
+                       + str(stats["turns"]) + " turns (" + "%.1f" % (stats["used"] / stats["turns"])
+                       + " per turn), and ran out of it in " + str(stats["exhausted"]) + " of them")
+
+    def display_board(self):
+        if self.headless:
+            return
+        if self.board_renderer is None:
+            self.board.print_board()
+        else:
+            self.board_renderer.render()
+
     def remove_losing_players(self):
-        # Check if any players have had all of their units destroyed, and remove them from the players list
-        players_to_remove = []
-        for player_id, player_r in self.players.items():
-            if player_r.num_units() == 0:
-                players_to_remove.append(player_id)
+        # Remove the players who have had all of their units destroyed. The board keeps track of them as their last
+        # unit is despawned, so the other players need not be checked
+        if not self.board.pending_eliminations:
+            return
+        for player_id in sorted(self.board.pending_eliminations):
+            if player_id in self.players and self.players[player_id].num_units() == 0:
+                del self.players[player_id]
                 logger.log(30, "Player " + str(player_id) + " eliminated")
-        for player_id in players_to_remove:
-            del self.players[player_id]
+        self.board.pending_eliminations.clear()
 
-    def announce_winner(self):
-        # Check and report the winning player(s).
+    def get_winners(self):
+        # Return the winning player id(s) and their number of remaining units.
         # If only one player remains, they win. Otherwise, check number of remaining units per player.
         # The winners are all the players who hold the highest number of remaining units.
+        tied_players = []
+        max_num_units_left = -1
+        for player_id, player_r in self.players.items():
+            num_units = player_r.num_units()
+            if num_units > max_num_units_left:
+                tied_players = [player_id]
+                max_num_units_left = num_units
+            elif num_units == max_num_units_left:
+                tied_players.append(player_id)
+        return tied_players, max_num_units_left
+
+    def announce_winner(self):
+        # Check and report the winning player(s).
+        winners, max_num_units_left = self.get_winners()
 
         if self.one_player_left():
-            logger.log(30, "Player " + str(list(self.players)[0]) + " has won the game")
+            logger.log(30, "Player " + str(winners[0]) + " has won the game")
             return
 
-        #  Make a player id -> remaining units dict, check max value, then get all player ids with this max value
-        remaining_units = {player_id: self.players[player_id].num_units() for player_id in self.players}
-        max_num_units_left = max(remaining_units.values())
-        tied_players = [player_id for player_id in remaining_units
-                        if remaining_units[player_id] == max_num_units_left]
-
-        if len(tied_players) == 1:
-            logger.log(30, "Turn limit reached, player " + str(tied_players[0]) + " wins with "
+        if len(winners) == 1:
+            logger.log(30, "Turn limit reached, player " + str(winners[0]) + " wins with "
                        + str(max_num_units_left) + " units remaining")
             return
 
-        logger.log(30, "Turn limit reached, players " + str(tied_players) + " are tied with "
+        logger.log(30, "Turn limit reached, players " + str(winners) + " are tied with "
                    + str(max_num_units_left) + " units remaining")
 
     def one_player_left(self):
@@ -131,22 +232,68 @@ class Game:
         return self.turn_limit_reached() or self.one_player_left()
 
     def start_game(self):
+        if self.seed is not None:
+            random.seed(self.seed)
         self.populate_players()
-        self.spawn_initial_units()
+        try:
+            # The replay file is closed (and flushed) even if the initial units cannot be placed
+            if self.replay_path is not None:
+                self.replay_recorder = replay.ReplayRecorder(self.replay_path, self.board, self.turn_handler,
+                                                             len(self.players))
+                self.board.event_recorder = self.replay_recorder
+            self.spawn_initial_units()
 
-        while not self.game_ended():
-            self.turn()
+            if self.execution_mode == "speculative":
+                self.round_executor = speculative.SpeculativeExecutor(
+                    self.board, self.turn_handler, self.user_commands, self.player_scripts, self.board_size,
+                    self.unit_limit_pct, self.num_workers)
+            elif self.execution_mode == "batched":
+                self.round_executor = batched.BatchedExecutor(self.board, self.turn_handler, self.interpreter,
+                                                              self.player_scripts, self.run_script)
+            while not self.game_ended():
+                self.turn()
+            if self.replay_recorder is not None:
+                self.replay_recorder.record_end(self.players)
+        finally:
+            if self.round_executor is not None:
+                self.round_executor.shutdown()
+            if self.replay_recorder is not None:
+                self.replay_recorder.close()
 
+        if self.board_renderer is not None and not self.headless:
+            self.board_renderer.render(force=True)  # Always show the final state of the board
         self.announce_winner()
+        if self.turn_budget is not None:
+            self.report_budget_usage()
 
 
 def main():
     # Argument parsing
     parser = argparse.ArgumentParser()
     parser.add_argument('-f', '--filepaths', nargs='*', help='Filepaths for bot strategy scripts')
-    paths = parser.parse_args().filepaths
+    parser.add_argument('-s', '--seed', type=int, help='Seed for the random number generator')
+    parser.add_argument('-p', '--parallel', type=int, metavar='NUM_WORKERS',
+                        help='Evaluate unit scripts speculatively in parallel, using NUM_WORKERS processes')
+    parser.add_argument('--batched', action='store_true',
+                        help='Evaluate the leading definitions of the scripts of each round in one pass per player')
+    parser.add_argument('-b', '--board-backend', choices=['dense', 'sparse'], default='dense',
+                        help='Store every tile of the board, or only the occupied ones (for very large boards)')
+    parser.add_argument('--budget', type=int, help='Maximum total cost of the commands a unit may execute per turn')
+    parser.add_argument('-r', '--replay', help='Record the events of the game to a replay file at this path')
+    parser.add_argument('-d', '--display', choices=['log', 'terminal'], default='log',
+                        help='Print the full board through the log every turn, or draw it on the terminal')
+    parser.add_argument('--fps', type=float, help='Maximum frames per second in terminal display mode')
+    parser.add_argument('--every-n-rounds', type=int,
+                        help='Only draw the board every N rounds in terminal display mode')
+    args = parser.parse_args()
+    if args.parallel is not None and args.batched:
+        parser.error("-p/--parallel and --batched are mutually exclusive")
+    execution_mode = "speculative" if args.parallel is not None else "batched" if args.batched else "serial"
 
-    game = Game(paths)
+    game = Game(args.filepaths, display_mode=args.display, render_max_fps=args.fps,
+                render_every_n_rounds=args.every_n_rounds, seed=args.seed, board_backend=args.board_backend,
+                turn_budget=args.budget, execution_mode=execution_mode, num_workers=args.parallel,
+                replay_path=args.replay)
     game.start_game()
 
 
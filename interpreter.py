@@ -1,5 +1,5 @@
 import re
-from cmd import CommandsInspector
+from cmd import CommandsInspector, COMMAND_COSTS, DEFAULT_COMMAND_COST
 
 
 class Interpreter:
@@ -7,6 +7,13 @@ class Interpreter:
     def __init__(self, turn_handler, commands):
         self.turn_handler = turn_handler
         self.commands = commands
+        self.analyzed_scripts = {}  # Script text -> analyzed script, see analyze_script
+
+    def bind(self, turn_handler, commands):
+        # Attach the interpreter to a different game. Analyzed scripts only refer to the turn handler and commands
+        # through the interpreter, so they remain valid and are executed against the new game
+        self.turn_handler = turn_handler
+        self.commands = commands
 
     @staticmethod
     def is_number(expr):
@@ -135,7 +142,10 @@ class Interpreter:
         return CommandsInspector.execute_command(self.commands, cmd, args_eval)
 
     def eval_and_exec(self, cmd, args):
-        # Command execution requires special handling for define and if statements
+        # Command execution requires special handling for define and if statements. If turns have an instruction
+        # budget, the cost of the command is counted first, which ends the turn if the budget runs out
+        if self.turn_handler.turn_budget is not None:
+            self.turn_handler.spend_budget(COMMAND_COSTS.get(cmd, DEFAULT_COMMAND_COST))
         if cmd == "define":
             return self.eval_and_exec_define(cmd, args)
         elif cmd == "if_else":
@@ -194,3 +204,9 @@ class Interpreter:
                 raise Exception("Syntax error in expression " + str(expr))
 
         return lambda: self.execute_multiple(exprs_processed)
+
+    def analyze_script(self, script):
+        # Analyze a whole script, reusing the result if the same script has been analyzed before
+        if script not in self.analyzed_scripts:
+            self.analyzed_scripts[script] = self.analyze(script)
+        return self.analyzed_scripts[script]
@@ -0,0 +1,106 @@
+import shutil
+import sys
+import time
+
+
+class TerminalRenderer:
+    # This class draws the board directly on the terminal. Unlike Board.print_board, which rebuilds and logs the entire
+    # board every turn, it keeps the previously drawn frame and only redraws the tiles that changed since then, using
+    # ANSI cursor addressing. Output is capped to a maximum number of frames per second and/or to once every N rounds,
+    # independently of how fast the simulation itself runs. Only the occupied tiles are looked up, even on a full
+    # redraw, and only the part of the board which fits in the terminal is drawn, so that very large (sparse) boards can
+    # be displayed too. Empty tiles are drawn as X on dense boards, and left blank on sparse boards.
+    def __init__(self, board, turn_handler, max_fps=None, every_n_rounds=None, stream=None):
+        self.board = board
+        self.turn_handler = turn_handler
+        self.min_frame_interval = 1 / max_fps if max_fps else 0
+        self.every_n_rounds = every_n_rounds
+        self.stream = sys.stdout if stream is None else stream
+
+        self.cell_width = 1
+        self.empty_text = ' ' if board.board_backend == "sparse" else 'X'
+        self.visible_size = board.board_size  # Number of rows and columns of tiles drawn
+        self.drawn = {}  # Location tuple -> text currently drawn on that tile. Empty tiles are not stored
+        self.changed_locs = set()  # Tiles whose contents changed since the last drawn frame
+        self.needs_full_redraw = True
+        self.last_frame_time = None
+        self.last_frame_round = None
+
+        board.tile_change_listeners.append(self.on_tile_changed)
+
+    def on_tile_changed(self, loc, unit):
+        self.changed_locs.add((loc[0] % self.board.board_size[0], loc[1] % self.board.board_size[1]))
+
+    def frame_due(self):
+        # Check whether enough time and rounds have passed since the last frame for a new one to be drawn
+        if self.every_n_rounds is not None:
+            round_number = self.turn_handler.round_number
+            if round_number == self.last_frame_round or round_number % self.every_n_rounds != 0:
+                return False
+        if self.last_frame_time is not None \
+                and time.monotonic() - self.last_frame_time < self.min_frame_interval:
+            return False
+        return True
+
+    def render(self, force=False):
+        # Draw a new frame if one is due (or if forced, e.g. for the final state of the board)
+        if not force and not self.frame_due():
+            return
+        self.last_frame_time = time.monotonic()
+        self.last_frame_round = self.turn_handler.round_number
+
+        if self.needs_full_redraw:
+            self.draw_full()
+        else:
+            self.draw_changes()
+        # Park the cursor below the board so that any other output does not overwrite it
+        self.stream.write("\x1b[" + str(self.visible_size[0] + 1) + ";1H")
+        self.stream.flush()
+
+    def tile_text(self, loc):
+        unit = self.board.get_unit_in_loc(loc)
+        return self.empty_text if unit is None else str(unit.id)
+
+    def tile_output(self, loc, text):
+        # Output drawing text on a tile, or nothing if the tile does not fit in the terminal
+        if loc[0] >= self.visible_size[0] or loc[1] >= self.visible_size[1]:
+            return ""
+        return ("\x1b[" + str(loc[0] + 1) + ";" + str(loc[1] * (self.cell_width + 1) + 1) + "H"
+                + text.ljust(self.cell_width))
+
+    def draw_full(self):
+        # Clear the screen and draw the board: the background of empty tiles, then every unit on it
+        self.needs_full_redraw = False
+        self.changed_locs.clear()
+        self.drawn = {loc: str(t_unit.id) for loc, t_unit in self.board.occupied_tiles()}
+        self.cell_width = max([self.cell_width] + [len(text) for text in self.drawn.values()])
+        self.visible_size = self.board.board_size
+        if self.stream.isatty():
+            columns, lines = shutil.get_terminal_size()
+            self.visible_size = [min(self.board.board_size[0], lines - 1),
+                                 min(self.board.board_size[1], (columns + 1) // (self.cell_width + 1))]
+        output = ["\x1b[2J\x1b[H"]
+        if self.empty_text != ' ':
+            row = ' '.join([self.empty_text.ljust(self.cell_width)] * self.visible_size[1])
+            output.append('\n'.join([row] * self.visible_size[0]))
+        output.extend(self.tile_output(loc, text) for loc, text in self.drawn.items())
+        self.stream.write(''.join(output))
+
+    def draw_changes(self):
+        # Redraw only the tiles that changed since the last frame. If a unit id no longer fits in the current cell
+        # width, the cells are widened and the whole board is redrawn instead
+        output = []
+        for loc in self.changed_locs:
+            text = self.tile_text(loc)
+            if text == self.drawn.get(loc, self.empty_text):
+                continue
+            if len(text) > self.cell_width:
+                self.draw_full()
+                return
+            if text == self.empty_text:
+                del self.drawn[loc]
+            else:
+                self.drawn[loc] = text
+            output.append(self.tile_output(loc, text))
+        self.changed_locs.clear()
+        self.stream.write(''.join(output))
@@ -0,0 +1,70 @@
+import struct
+
+# Replays are binary files made of a fixed-size header followed by fixed-width event records, so that they can be
+# memory-mapped and analyzed as columns (see replay_query.py) without being parsed. All values are little-endian.
+MAGIC = b"BBREPLAY"
+VERSION = 1
+HEADER = struct.Struct("<8sHHIIH14x")  # Magic, version, record size, board size (x, y), number of players
+RECORD = struct.Struct("<IBBHIiiIi")  # Turn, event, command, player, unit, x, y, other unit, value
+RECORD_FIELDS = ["turn", "event", "command", "player", "unit", "x", "y", "other", "value"]
+
+# Event types. The location of an event is the unit's location (normalized to the board), and the meaning of the
+# "other unit" and "value" fields depends on the event
+SPAWN = 1  # Unit spawned
+MOVE = 2  # Unit moved to the location
+ATTACK = 3  # Unit attacked another unit. Other unit: the unit attacked, value: damage dealt
+DAMAGE = 4  # Unit took damage. Value: damage taken (0 if it was blocked by defending)
+DEATH = 5  # Unit destroyed
+ELIMINATION = 6  # Player lost their last unit. Unit: the unit destroyed
+COMMAND = 7  # Unit executed a critical command (see the command field)
+END = 8  # Game ended with the player still in it. Value: number of units remaining
+EVENT_NAMES = {SPAWN: "spawn", MOVE: "move", ATTACK: "attack", DAMAGE: "damage", DEATH: "death",
+               ELIMINATION: "elimination", COMMAND: "command", END: "end"}
+
+# Every event is tagged with the last critical command executed by the acting unit (0 if none yet), so that events
+# can be attributed to commands. For example, the death of a unit attacked by a charged attack on the attacker's turn is
+# tagged with charge_attack.
+COMMANDS = ["attack", "charge_attack", "move", "spawn", "wait", "defend", "fortify"]
+COMMAND_CODES = {name: code for code, name in enumerate(COMMANDS, 1)}
+
+BUFFER_RECORDS = 4096  # Number of records buffered before they are written to the file
+
+
+class ReplayRecorder:
+    # Records the events of a game to a replay file. The board, units and commands report events to it through
+    # the board's event_recorder.
+    def __init__(self, path, board, turn_handler, num_players):
+        self.board = board
+        self.turn_handler = turn_handler
+        self.last_commands = {}  # Unit id -> code of the last critical command the unit executed
+        self.buffer = []
+        self.output_file = open(path, 'wb')
+        self.output_file.write(HEADER.pack(MAGIC, VERSION, RECORD.size, board.board_size[0], board.board_size[1],
+                                           num_players))
+
+    def record(self, event, unit, other=0, value=0, loc=None):
+        loc = unit.loc if loc is None else loc
+        queue = self.turn_handler.queue
+        command = self.last_commands.get(queue[-1].id, 0) if queue else 0
+        self.buffer.append(RECORD.pack(self.turn_handler.turn_number, event, command, unit.player_id, unit.id,
+                                       loc[0] % self.board.board_size[0], loc[1] % self.board.board_size[1],
+                                       other, value))
+        if len(self.buffer) >= BUFFER_RECORDS:
+            self.flush()
+
+    def record_command(self, unit, name):
+        self.last_commands[unit.id] = COMMAND_CODES[name]
+        self.record(COMMAND, unit)
+
+    def record_end(self, players):
+        for player_r in players.values():
+            self.buffer.append(RECORD.pack(self.turn_handler.turn_number, END, 0, player_r.id, 0, 0, 0, 0,
+                                           player_r.num_units()))
+
+    def flush(self):
+        self.output_file.write(b"".join(self.buffer))
+        self.buffer = []
+
+    def close(self):
+        self.flush()
+        self.output_file.close()
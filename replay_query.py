@@ -0,0 +1,165 @@
+import numpy as np
+import argparse
+import replay
+
+# Replay records as a NumPy structured type. The fields and their sizes match replay.RECORD exactly (no padding), so
+# replay files can be memory-mapped as arrays of records.
+RECORD_DTYPE = np.dtype([("turn", "<u4"), ("event", "u1"), ("command", "u1"), ("player", "<u2"), ("unit", "<u4"),
+                         ("x", "<i4"), ("y", "<i4"), ("other", "<u4"), ("value", "<i4")])
+assert RECORD_DTYPE.itemsize == replay.RECORD.size and list(RECORD_DTYPE.names) == replay.RECORD_FIELDS
+
+CHUNK_RECORDS = 1 << 20  # Number of records processed at once. Only this many records are paged in at a time
+HEATMAP_SHADES = " .:-=+*#%@"
+
+
+def open_replay(path):
+    # Return the header of a replay file as a dict, and its records as a read-only memory-mapped array
+    with open(path, 'rb') as input_file:
+        header = input_file.read(replay.HEADER.size)
+        input_file.seek(0, 2)
+        file_size = input_file.tell()
+    if len(header) < replay.HEADER.size:
+        raise Exception("Not a replay file: " + path)
+    magic, version, record_size, board_x, board_y, num_players = replay.HEADER.unpack(header)
+    if magic != replay.MAGIC:
+        raise Exception("Not a replay file: " + path)
+    if version != replay.VERSION or record_size != RECORD_DTYPE.itemsize:
+        raise Exception("Unsupported replay version " + str(version) + " in " + path)
+    num_records = (file_size - replay.HEADER.size) // record_size
+    if num_records == 0:
+        records = np.zeros(0, dtype=RECORD_DTYPE)
+    else:
+        records = np.memmap(path, dtype=RECORD_DTYPE, mode='r', offset=replay.HEADER.size, shape=(num_records,))
+    return {"board_size": (board_x, board_y), "num_players": num_players}, records
+
+
+def iter_chunks(records, chunk_records=CHUNK_RECORDS):
+    for start in range(0, len(records), chunk_records):
+        yield records[start:start + chunk_records]
+
+
+########################################################################################################################
+# Queries
+########################################################################################################################
+
+def occupancy_heatmap(paths, bins=None):
+    # Count how many times a unit entered (spawned on or moved to) each tile, over all replays. Locations are scaled
+    # to a grid of the given number of bins along each axis, so that replays of different board sizes can be combined.
+    # By default, the grid is the board itself, which requires all replays to have the same board size.
+    heatmap = None
+    bins_from_board = bins is None
+    for path in paths:
+        header, records = open_replay(path)
+        board_size = header["board_size"]
+        if bins is None:
+            bins = board_size
+        elif bins_from_board and bins != board_size:
+            raise Exception("Replays have different board sizes, the number of bins must be given")
+        if heatmap is None:
+            heatmap = np.zeros(bins[0] * bins[1], dtype=np.int64)
+        for chunk in iter_chunks(records):
+            entered = chunk[(chunk["event"] == replay.SPAWN) | (chunk["event"] == replay.MOVE)]
+            bin_x = entered["x"].astype(np.int64) * bins[0] // board_size[0]
+            bin_y = entered["y"].astype(np.int64) * bins[1] // board_size[1]
+            heatmap += np.bincount(bin_x * bins[1] + bin_y, minlength=heatmap.size)
+    if heatmap is None:
+        return np.zeros((0, 0), dtype=np.int64)
+    return heatmap.reshape(bins[0], bins[1])
+
+
+def first_contact_turns(paths):
+    # Return the turn of the first attack which hit an enemy unit in each replay, and the number of replays in which no
+    # unit ever attacked another. Only the records up to the first attack are read.
+    turns = []
+    num_without_contact = 0
+    for path in paths:
+        _, records = open_replay(path)
+        for chunk in iter_chunks(records):
+            attacks = np.flatnonzero(chunk["event"] == replay.ATTACK)
+            if attacks.size:
+                turns.append(int(chunk["turn"][attacks[0]]))
+                break
+        else:
+            num_without_contact += 1
+    return np.array(turns, dtype=np.int64), num_without_contact
+
+
+def kill_rates(paths):
+    # Count, for each critical command, how many times it was executed and how many units were destroyed on turns of
+    # units whose last command it was (e.g. kills by a charged attack count towards charge_attack). Index 0 holds the
+    # kills by units which had not executed any command yet.
+    num_codes = len(replay.COMMANDS) + 1
+    executions = np.zeros(num_codes, dtype=np.int64)
+    kills = np.zeros(num_codes, dtype=np.int64)
+    for path in paths:
+        _, records = open_replay(path)
+        for chunk in iter_chunks(records):
+            executions += np.bincount(chunk["command"][chunk["event"] == replay.COMMAND], minlength=num_codes)
+            kills += np.bincount(chunk["command"][chunk["event"] == replay.DEATH], minlength=num_codes)
+    return executions, kills
+
+
+########################################################################################################################
+# Reports
+########################################################################################################################
+
+def print_heatmap(heatmap):
+    peak = heatmap.max() if heatmap.size else 0
+    for row in heatmap:
+        if peak == 0:
+            print(HEATMAP_SHADES[0] * len(row))
+            continue
+        print("".join(HEATMAP_SHADES[int(value * (len(HEATMAP_SHADES) - 1) / peak)] for value in row))
+    print("Most entered tile: " + str(peak) + " times")
+
+
+def print_first_contact(turns, num_without_contact):
+    print(str(len(turns)) + " replays with contact, " + str(num_without_contact) + " without")
+    if len(turns) == 0:
+        return
+    print("Mean first contact turn: " + "%.1f" % turns.mean())
+    for percentile, turn in zip([10, 25, 50, 75, 90], np.percentile(turns, [10, 25, 50, 75, 90])):
+        print(("p" + str(percentile)).ljust(6) + "%.0f" % turn)
+
+
+def print_kill_rates(executions, kills):
+    names = ["(none)"] + replay.COMMANDS
+    print("command".ljust(16) + "executed".rjust(12) + "kills".rjust(10) + "kills/use".rjust(12))
+    for code, name in enumerate(names):
+        if executions[code] == 0 and kills[code] == 0:
+            continue
+        rate = "%.4f" % (kills[code] / executions[code]) if executions[code] else "-"
+        print(name.ljust(16) + str(executions[code]).rjust(12) + str(kills[code]).rjust(10) + rate.rjust(12))
+
+
+def main():
+    # Argument parsing
+    parser = argparse.ArgumentParser(description="Compute aggregate statistics over replay files")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    heatmap_parser = subparsers.add_parser("heatmap", help="How often units entered each tile")
+    heatmap_parser.add_argument('paths', nargs='+', help='Replay files')
+    heatmap_parser.add_argument('--bins', type=int, nargs=2, metavar=('X', 'Y'),
+                                help='Size of the heatmap grid (default: the board size)')
+    heatmap_parser.add_argument('-o', '--output', help='Also save the heatmap as a .npy file')
+
+    contact_parser = subparsers.add_parser("contact", help="Distribution of the turn of the first attack")
+    contact_parser.add_argument('paths', nargs='+', help='Replay files')
+
+    kills_parser = subparsers.add_parser("kills", help="Kill rates per command")
+    kills_parser.add_argument('paths', nargs='+', help='Replay files')
+    args = parser.parse_args()
+
+    if args.command == "heatmap":
+        heatmap = occupancy_heatmap(args.paths, tuple(args.bins) if args.bins else None)
+        print_heatmap(heatmap)
+        if args.output:
+            np.save(args.output, heatmap)
+    elif args.command == "contact":
+        print_first_contact(*first_contact_turns(args.paths))
+    else:
+        print_kill_rates(*kill_rates(args.paths))
+
+
+if __name__ == "__main__":
+    main()
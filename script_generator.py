@@ -0,0 +1,165 @@
+import inspect
+from cmd import Commands
+from interpreter import Interpreter
+
+# Script statements are represented as trees. A node is either a number, a symbol (string), or a command, which is a
+# (name, args) tuple. Each argument of a command is a node, except for the branches of if/if_else, which are blocks
+# (lists of nodes) since they may contain several commands. Command names are the ones used in scripts (e.g. "and"
+# rather than "i_and").
+
+SPECIAL_COMMANDS = ["define", "if_else"]  # Commands with special argument handling, generated separately
+EXCLUDED_COMMANDS = ["prnt"]  # Debugging output, not part of the documented language
+SCRIPT_NAMES = {"i_and": "and", "i_or": "or"}  # Command names which differ between scripts and the Commands class
+
+
+def command_table():
+    # Build the table of user commands from the Commands class: name -> (number of arguments, is critical action)
+    table = {}
+    for name, member in inspect.getmembers(Commands, callable):
+        if name.startswith("_") or name in EXCLUDED_COMMANDS:
+            continue
+        params = list(inspect.signature(member).parameters)
+        if params and params[0] == "self":
+            params = params[1:]
+        table[SCRIPT_NAMES.get(name, name)] = (len(params), getattr(member, "is_critical", False))
+    return table
+
+
+def render_node(node):
+    if isinstance(node, tuple):
+        name, args = node
+        return name + "(" + ", ".join(render_arg(arg) for arg in args) + ")"
+    return str(node)
+
+
+def render_arg(arg):
+    if isinstance(arg, list):
+        return " ".join(render_node(node) for node in arg)
+    return render_node(arg)
+
+
+def render_script(statements):
+    return "\n".join(render_node(statement) for statement in statements)
+
+
+def parse_node(expr):
+    # Parse a single expression into a node, the same way Interpreter.analyze does
+    if Interpreter.is_number(expr):
+        return Interpreter.get_number_value(expr)
+    if Interpreter.is_symbol(expr):
+        return expr
+    if Interpreter.is_command(expr):
+        name = Interpreter.get_cmd(expr)
+        args = []
+        for idx, arg in enumerate(Interpreter.get_args(expr)):
+            nodes = [parse_node(arg_expr) for arg_expr in Interpreter.parse(arg)]
+            if name in ["if", "if_else"] and idx > 0:
+                args.append(nodes)
+            elif len(nodes) == 1:
+                args.append(nodes[0])
+            else:
+                raise Exception("Syntax error in expression " + str(expr))
+        return name, args
+    raise Exception("Syntax error in expression " + str(expr))
+
+
+def parse_script(script):
+    return [parse_node(expr) for expr in Interpreter.parse(script)]
+
+
+def uses_defined_symbols(statements, defined=()):
+    # Check that every symbol read in a block is certainly defined by the time it is read. Symbols defined in a block
+    # are only visible later in the same block (since the block may not be executed)
+    defined = list(defined)
+    return all(node_uses_defined_symbols(statement, defined) for statement in statements)
+
+
+def node_uses_defined_symbols(node, defined):
+    if isinstance(node, str):
+        return node in defined
+    if not isinstance(node, tuple):
+        return True
+    name, args = node
+    if name == "define":
+        if not node_uses_defined_symbols(args[1], defined):
+            return False
+        if args[0] not in defined:
+            defined.append(args[0])
+        return True
+    if name in ["if", "if_else"]:
+        return node_uses_defined_symbols(args[0], defined) \
+            and all(uses_defined_symbols(branch, defined) for branch in args[1:])
+    return all(node_uses_defined_symbols(arg, defined) for arg in args)
+
+
+class ScriptGenerator:
+    # Generates random valid scripts. Only symbols which are certainly defined by the time they are used are read, and
+    # division is only by non-zero constants, so generated scripts do not fail (though they may make little sense).
+    def __init__(self, rng, max_depth=3, max_statements=6, max_block_statements=3):
+        self.rng = rng
+        self.max_depth = max_depth
+        self.max_statements = max_statements
+        self.max_block_statements = max_block_statements
+
+        table = command_table()
+        self.actions = sorted(name for name, (_, critical) in table.items() if critical)
+        self.sensors = sorted(name for name, (num_args, critical) in table.items()
+                              if not critical and num_args == 0)
+        self.operators = sorted((name, num_args) for name, (num_args, critical) in table.items()
+                                if not critical and num_args > 0 and name not in SPECIAL_COMMANDS)
+
+    def script(self):
+        return self.block([], 0, self.max_statements)
+
+    def block(self, defined, depth, max_statements=None):
+        # Generate a sequence of statements. Symbols defined in it are only visible later in the same block
+        defined = list(defined)
+        max_statements = self.max_block_statements if max_statements is None else max_statements
+        return [self.statement(defined, depth) for _ in range(self.rng.randint(1, max_statements))]
+
+    def statement(self, defined, depth):
+        kinds = ["define", "action"] if depth >= self.max_depth else ["define", "action", "if"]
+        kind = self.rng.choice(kinds)
+        if kind == "define":
+            if defined and self.rng.random() < 0.3:
+                symbol = self.rng.choice(defined)
+            else:
+                symbol = "v" + str(len(defined))
+            value = self.expression(defined, depth + 1)
+            if symbol not in defined:
+                defined.append(symbol)
+            return "define", [symbol, value]
+        if kind == "if":
+            predicate = self.expression(defined, depth + 1)
+            if self.rng.random() < 0.5:
+                return "if", [predicate, self.block(defined, depth + 1)]
+            return "if_else", [predicate, self.block(defined, depth + 1), self.block(defined, depth + 1)]
+        return self.action()
+
+    def action(self):
+        name = self.rng.choice(self.actions)
+        if name == "charge_attack":
+            return name, [self.rng.randint(0, 3)]
+        return name, []
+
+    def number(self):
+        return self.rng.choice([0, 1, 1, 2, 3, 4, 5, 10, 20])
+
+    def expression(self, defined, depth):
+        kinds = ["number", "sensor"]
+        if defined:
+            kinds.append("symbol")
+        if depth < self.max_depth:
+            kinds += ["operator", "operator"]
+        kind = self.rng.choice(kinds)
+        if kind == "number":
+            return self.number()
+        if kind == "symbol":
+            return self.rng.choice(defined)
+        if kind == "sensor":
+            return self.rng.choice(self.sensors), []
+        name, num_args = self.rng.choice(self.operators)
+        args = [self.expression(defined, depth + 1) for _ in range(num_args)]
+        if name == "div":
+            args[1] = self.rng.choice([1, 2, 3, 4, 5])
+        return name, args
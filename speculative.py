@@ -0,0 +1,332 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from change_tracker import ChangeTracker
+import board
+import cmd
+import interpreter
+import player
+import turn_handler
+import unit
+import logging
+import os
+from time import perf_counter
+
+# Setup logging
+logger = logging.getLogger(__name__)
+logger.setLevel(1)
+
+# Rounds are only evaluated speculatively if at least this fraction of the turns of the last round evaluated
+# speculatively was committed, and if speculative rounds took less time per turn than serial ones (snapshotting the
+# board and validating reads is wasted when most turns are executed serially anyway). After PROBE_INTERVAL rounds, the
+# other choice is made for one round, so that both are measured again; the interval doubles after each such round, until
+# the choice changes
+MIN_COMMIT_RATE = 0.5
+PROBE_INTERVAL = 16
+
+
+class NeedsSerialExecution(Exception):
+    # Raised when a unit's script cannot be evaluated speculatively, and must instead be executed on its turn
+    pass
+
+
+class RecordingCommands(cmd.Commands):
+    # Commands used for speculative evaluation of scripts against a snapshot of the board. Sensor values read are
+    # recorded so they can later be validated, and critical actions are recorded instead of being performed.
+    def __init__(self, board, turn_handler):
+        super().__init__(board, turn_handler)
+        self.reads = []
+        self.action = None
+        self.board_changed = False  # Whether the recorded action may change the board, invalidating later reads
+
+    def start_recording(self):
+        self.reads = []
+        self.action = None
+        self.board_changed = False
+
+    def record_read(self, sensor, value):
+        if self.board_changed:
+            raise NeedsSerialExecution()
+        self.reads.append((sensor, value))
+        return value
+
+    def record_action(self, name, *args):
+        self.action = (name, args)
+        self.board_changed = name in ("attack", "move") or (name == "charge_attack" and args[0] == 0)
+
+    @cmd.critical_action
+    def attack(self):
+        self.record_action("attack")
+
+    @cmd.critical_action
+    def charge_attack(self, num_turns):
+        self.record_action("charge_attack", num_turns)
+
+    @cmd.critical_action
+    def move(self):
+        self.record_action("move")
+
+    @cmd.critical_action
+    def spawn(self):
+        self.record_action("spawn")
+
+    @cmd.critical_action
+    def wait(self):
+        self.record_action("wait")
+
+    @cmd.critical_action
+    def defend(self):
+        self.record_action("defend")
+
+    @cmd.critical_action
+    def fortify(self):
+        self.record_action("fortify")
+
+    def num_adjacent_allies(self):
+        return self.record_read("num_adjacent_allies", super().num_adjacent_allies())
+
+    def num_adjacent_enemies(self):
+        return self.record_read("num_adjacent_enemies", super().num_adjacent_enemies())
+
+    def num_total_allies(self):
+        return self.record_read("num_total_allies", super().num_total_allies())
+
+    def num_total_enemies(self):
+        return self.record_read("num_total_enemies", super().num_total_enemies())
+
+    def distance_from_closest_ally(self):
+        return self.record_read("distance_from_closest_ally", super().distance_from_closest_ally())
+
+    def distance_from_closest_enemy(self):
+        return self.record_read("distance_from_closest_enemy", super().distance_from_closest_enemy())
+
+    @staticmethod
+    def prnt(a):
+        # Printing is a side effect, so it must happen on the unit's actual turn
+        raise NeedsSerialExecution()
+
+
+class SpeculationWorker:
+    # Holds a shadow copy of the game inside a worker process, and evaluates unit scripts against round-start
+    # snapshots of the board
+    def __init__(self, scripts, board_size, unit_limit_pct, board_backend, turn_budget):
+        self.turn_handler = turn_handler.TurnHandler()
+        self.turn_handler.turn_budget = turn_budget
+        self.players = {}
+        self.board = board.Board(self.turn_handler, self.players, board_size, unit_limit_pct, board_backend)
+        self.commands = RecordingCommands(self.board, self.turn_handler)
+        self.interpreter = interpreter.Interpreter(self.turn_handler, self.commands)
+        self.scripts = {player_id: self.interpreter.analyze(script) for player_id, script in scripts.items()}
+        self.units = {}
+
+    def load_snapshot(self, snapshot):
+        # Replace the shadow board contents with the snapshot
+        for shadow_unit in self.units.values():
+            self.board.board_matrix[shadow_unit.loc] = None
+        self.players.clear()
+        self.units = {}
+        for player_id, unit_states in snapshot:
+            self.players[player_id] = player.Player(player_id, self.scripts[player_id])
+            for unit_id, loc, spawn_timer, charge_timer, unit_turn_number, var_data in unit_states:
+                shadow_unit = unit.Unit(self.board, unit_id, player_id, loc)
+                shadow_unit.spawn_timer = spawn_timer
+                shadow_unit.charge_timer = charge_timer
+                shadow_unit.unit_turn_number = unit_turn_number
+                shadow_unit.var_data = var_data
+                self.board.board_matrix[loc] = shadow_unit
+                self.players[player_id].units.add(shadow_unit)
+                self.units[unit_id] = shadow_unit
+        self.board.num_total_units = len(self.units)
+
+    def speculate(self, snapshot, unit_ids):
+        self.load_snapshot(snapshot)
+        return [(unit_id, self.speculate_unit(self.units[unit_id])) for unit_id in unit_ids]
+
+    def speculate_unit(self, shadow_unit):
+        # Evaluate the unit's script as it would be evaluated on its turn, returning the sensor values read, the
+        # critical action taken, the resulting variables and the instruction budget used, or None if the script must
+        # be executed serially.
+        # Only the parts of Unit.on_new_turn that affect the unit itself are simulated here; spawns and charged
+        # attacks change the board on the actual turn, which invalidates the recorded reads if they are affected.
+        shadow_unit.unit_turn_number += 1
+        if shadow_unit.spawn_timer > 0:
+            shadow_unit.spawn_timer -= 1
+        if shadow_unit.charge_timer > 0:
+            shadow_unit.charge_timer -= 1
+
+        self.turn_handler.queue = deque([shadow_unit])
+        self.turn_handler.performed_critical_action = False
+        self.turn_handler.reset_budget()
+        self.commands.start_recording()
+        try:
+            self.scripts[shadow_unit.player_id]()
+        except Exception:
+            # Scripts which fail, or run out of budget, are executed serially, so that they end the same way
+            return None
+        return self.commands.reads, self.commands.action, shadow_unit.var_data, self.turn_handler.budget_used
+
+
+_worker = None  # SpeculationWorker of the current worker process
+
+
+def init_worker(scripts, board_size, unit_limit_pct, board_backend, turn_budget):
+    global _worker
+    logging.disable(logging.CRITICAL)  # Logging happens when results are committed in the main process
+    _worker = SpeculationWorker(scripts, board_size, unit_limit_pct, board_backend, turn_budget)
+
+
+def speculate_group(snapshot, unit_ids):
+    return _worker.speculate(snapshot, unit_ids)
+
+
+class SpeculativeExecutor:
+    # This class runs the scripts of all units of a round in parallel worker processes, against a snapshot of the board
+    # taken at the start of the round. Results are then committed in turn order: on each unit's turn, the sensor
+    # values it read are validated against the changes made to the board since the snapshot, and its critical action
+    # is performed on the live board (so random choices are made in the same order as in serial execution). Units
+    # whose reads are no longer valid, or which could not be evaluated speculatively, are executed serially. The game
+    # therefore plays out exactly as it would with serial execution. Rounds in which this does not pay off are executed
+    # serially altogether (see MIN_COMMIT_RATE).
+    def __init__(self, board, turn_handler, commands, scripts, board_size, unit_limit_pct, num_workers=None,
+                 interaction_radius=2):
+        self.board = board
+        self.turn_handler = turn_handler
+        self.commands = commands
+        self.interaction_radius = interaction_radius
+        self.tracker = ChangeTracker(board)
+        self.num_workers = num_workers if num_workers is not None else os.cpu_count()
+        self.pool = ProcessPoolExecutor(max_workers=self.num_workers, initializer=init_worker,
+                                        initargs=(scripts, board_size, unit_limit_pct, board.board_backend,
+                                                  turn_handler.turn_budget))
+        self.results = {}  # Unit id -> speculative result for the current round
+        self.round_number = 0
+        self.speculating = True  # Whether the current round is evaluated speculatively
+        self.round_start = None  # Time at which the current round started
+        self.round_counts = [0, 0]  # [turns committed, turns] in the current round
+        self.commit_rate = 1  # Fraction of the turns of the last speculative round that were committed
+        self.turn_times = {}  # Whether rounds were evaluated speculatively -> average time per turn
+        self.preferred = None  # Whether speculative rounds are preferred, given the measurements so far
+        self.probe_interval = PROBE_INTERVAL
+        self.next_probe = PROBE_INTERVAL  # Round number in which the choice which is not preferred is made next
+        self.num_committed = 0
+        self.num_serial = 0
+
+    def shutdown(self):
+        self.pool.shutdown()
+        logger.log(10, "Speculative execution: " + str(self.num_committed) + " turns committed, "
+                   + str(self.num_serial) + " turns executed serially")
+
+    def take_snapshot(self):
+        return [(player_id, [(t_unit.id, list(t_unit.loc), t_unit.spawn_timer, t_unit.charge_timer,
+                              t_unit.unit_turn_number, dict(t_unit.var_data))
+                             for t_unit in self.board.players[player_id].units])
+                for player_id in self.board.players]
+
+    def partition_units(self, units):
+        # Partition units into spatially independent groups. The board is divided into square cells as wide as the
+        # interaction radius, and occupied cells which touch (taking wrapping into account) are joined into a group,
+        # so units in different groups are more than the interaction radius apart.
+        cell_size = self.interaction_radius
+        num_cells = [-(-self.board.board_size[0] // cell_size), -(-self.board.board_size[1] // cell_size)]
+        cells = {}
+        for t_unit in units:
+            cell = ((t_unit.loc[0] % self.board.board_size[0]) // cell_size,
+                    (t_unit.loc[1] % self.board.board_size[1]) // cell_size)
+            cells.setdefault(cell, []).append(t_unit.id)
+
+        parents = {cell: cell for cell in cells}
+
+        def find(cell):
+            while parents[cell] != cell:
+                parents[cell] = parents[parents[cell]]
+                cell = parents[cell]
+            return cell
+
+        for cell_x, cell_y in cells:
+            for x_adj in (-1, 0, 1):
+                for y_adj in (-1, 0, 1):
+                    neighbour = ((cell_x + x_adj) % num_cells[0], (cell_y + y_adj) % num_cells[1])
+                    if neighbour in parents:
+                        parents[find(neighbour)] = find((cell_x, cell_y))
+
+        groups = {}
+        for cell, unit_ids in cells.items():
+            groups.setdefault(find(cell), []).extend(unit_ids)
+        return list(groups.values())
+
+    def assign_groups(self, groups):
+        # Distribute the groups among the workers, largest first, always to the least loaded worker
+        batches = [[] for _ in range(self.num_workers)]
+        for group in sorted(groups, key=len, reverse=True):
+            min(batches, key=len).extend(group)
+        return [batch for batch in batches if batch]
+
+    def start_round(self):
+        # Decide whether this round is evaluated speculatively, and if so, evaluate the scripts of all units against the
+        # current board
+        self.measure_round()
+        self.results = {}
+        speculating = self.should_speculate()
+        self.round_number += 1
+        if speculating != self.speculating:
+            # The board's changes only need to be tracked in speculative rounds, and tracking costs time on every move
+            if speculating:
+                self.board.tile_change_listeners.append(self.tracker.on_tile_changed)
+            else:
+                self.board.tile_change_listeners.remove(self.tracker.on_tile_changed)
+        self.speculating = speculating
+        if not speculating:
+            return
+        self.tracker.reset()
+        snapshot = self.take_snapshot()
+        units = list(self.turn_handler.queue)
+        batches = self.assign_groups(self.partition_units(units))
+        futures = [self.pool.submit(speculate_group, snapshot, batch) for batch in batches]
+        for future in futures:
+            for unit_id, result in future.result():
+                if result is not None:
+                    self.results[unit_id] = result
+
+    def measure_round(self):
+        # Record the time per turn and the fraction of committed turns of the round which just ended
+        num_committed, num_turns = self.round_counts
+        self.round_counts = [0, 0]
+        if self.round_start is not None and num_turns:
+            time_per_turn = (perf_counter() - self.round_start) / num_turns
+            times = self.turn_times
+            times[self.speculating] = (times[self.speculating] + time_per_turn) / 2 \
+                if self.speculating in times else time_per_turn
+            if self.speculating:
+                self.commit_rate = num_committed / num_turns
+        self.round_start = perf_counter()
+
+    def should_speculate(self):
+        if len(self.turn_times) < 2:
+            return True not in self.turn_times  # Measure both choices first
+        preferred = self.commit_rate >= MIN_COMMIT_RATE and self.turn_times[True] <= self.turn_times[False]
+        if preferred != self.preferred:
+            self.preferred = preferred
+            self.probe_interval = PROBE_INTERVAL
+        if self.round_number < self.next_probe:
+            return preferred
+        self.probe_interval *= 2
+        self.next_probe = self.round_number + self.probe_interval
+        return not preferred
+
+    def execute_turn(self, acting_unit):
+        # Commit the speculative result for the acting unit, if it is still valid. Returns whether it was committed;
+        # otherwise the unit's script must be executed serially.
+        self.round_counts[1] += 1
+        result = self.results.pop(acting_unit.id, None)
+        if result is None or not all(self.tracker.read_is_valid(acting_unit, sensor, value)
+                                     for sensor, value in result[0]):
+            self.num_serial += 1
+            return False
+        reads, action, var_data, budget_used = result
+        acting_unit.var_data = var_data
+        self.turn_handler.budget_used = budget_used
+        if action is not None:
+            name, args = action
+            getattr(self.commands, name)(*args)
+        self.round_counts[0] += 1
+        self.num_committed += 1
+        return True
@@ -0,0 +1,69 @@
+import threading
+import unittest
+import logging
+import distributed
+
+STRATEGY_PATHS = ["strategies/test1.txt", "strategies/test2.txt"]
+CONFIG = {"board_size": [8, 8], "turn_limit": 60}
+
+
+def die(*args):
+    raise ConnectionError("Worker killed")
+
+
+class DistributedLadderTest(unittest.TestCase):
+    # Plays a ladder on workers running in threads on localhost, one of which dies after its first game
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self.servers = [distributed.WorkerServer(("127.0.0.1", 0)) for _ in range(3)]
+        for server in self.servers:
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.scripts = []
+        for path in STRATEGY_PATHS:
+            with open(path, 'r') as input_file:
+                self.scripts.append(input_file.read())
+
+    def tearDown(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+        logging.disable(logging.NOTSET)
+
+    def kill_after_first_job(self, server):
+        # Make the worker drop its coordinator connection in the middle of its second job, as if it had died
+        runner = server.runner
+        run_job = runner.run_job
+        num_jobs = [0]
+
+        def dying_run_job(*args):
+            num_jobs[0] += 1
+            return run_job(*args) if num_jobs[0] == 1 else die()
+
+        runner.run_job = dying_run_job
+
+    def test_all_jobs_finish_when_a_worker_dies(self):
+        jobs = distributed.ladder_jobs(self.scripts * 2, 3, CONFIG)
+        self.kill_after_first_job(self.servers[0])
+        coordinator = distributed.Coordinator([server.server_address for server in self.servers], batch_size=2)
+        results, failures = coordinator.run([job[1:] for job in jobs])
+
+        self.assertEqual(failures, {})
+        self.assertEqual(sorted(results), list(range(len(jobs))))
+        # Games are deterministic, so every result must match the game played locally
+        runner = distributed.MatchRunner()
+        for job_id, (_, scripts, config, seed) in enumerate(jobs):
+            self.assertEqual(results[job_id], runner.run_job(job_id, scripts, config, seed)[1:])
+
+    def test_no_workers_left(self):
+        jobs = distributed.ladder_jobs(self.scripts, 2, CONFIG)
+        for server in self.servers:
+            server.runner.run_job = die
+        coordinator = distributed.Coordinator([server.server_address for server in self.servers])
+        results, failures = coordinator.run([job[1:] for job in jobs])
+
+        self.assertEqual(results, {})
+        self.assertEqual(sorted(failures), list(range(len(jobs))))
+
+
+if __name__ == "__main__":
+    unittest.main()
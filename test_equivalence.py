@@ -0,0 +1,38 @@
+import unittest
+import equivalence
+
+SEEDS = range(5)
+LARGE_BOARD_SIZES = [40, 60]  # Large enough for the chunked searches of sparse boards and the change tracker's cells
+LARGE_BOARD_SEEDS = [2, 8]  # Games on large boards in which the units spread out enough to use them
+LARGE_BOARD_TURN_LIMIT = 1000
+TURN_BUDGET = 14
+
+
+class EquivalenceTest(unittest.TestCase):
+    # Plays random games under serial execution and under each of the other engine configurations, which must play
+    # them identically
+    def check_candidate(self, candidate, reference=None):
+        reference = reference if reference is not None else {}
+        for seed in SEEDS:
+            with self.subTest(seed=seed):
+                self.assertIsNone(equivalence.find_divergence(equivalence.generate_case(seed), reference, candidate))
+        for seed in LARGE_BOARD_SEEDS:
+            with self.subTest(seed=seed, board_sizes=LARGE_BOARD_SIZES):
+                case = equivalence.generate_case(seed, LARGE_BOARD_TURN_LIMIT, board_sizes=LARGE_BOARD_SIZES)
+                self.assertIsNone(equivalence.find_divergence(case, reference, candidate))
+
+    def test_batched(self):
+        self.check_candidate({"execution_mode": "batched"})
+
+    def test_batched_with_turn_budget(self):
+        self.check_candidate({"execution_mode": "batched", "turn_budget": TURN_BUDGET}, {"turn_budget": TURN_BUDGET})
+
+    def test_speculative(self):
+        self.check_candidate({"execution_mode": "speculative", "num_workers": 1})
+
+    def test_sparse(self):
+        self.check_candidate({"board_backend": "sparse"})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,13 +1,24 @@
 from collections import deque
 
 
+class BudgetExhausted(Exception):
+    # Raised when the acting unit's script runs out of instruction budget, ending its turn
+    pass
+
+
 class TurnHandler:
     # This class handles keeping track of turns. Which is the active unit/player, turn order, etc.
     def __init__(self):
         self.queue = deque()
         self.turn_number = 0
+        self.round_number = 0  # A round ends once every unit in the queue has had a turn
+        self.acted_this_round = set()
         self.performed_critical_action = None  # Critical actions are user-commands such as attack() or move(),
         # which may not be performed more than once a turn
+        self.turn_budget = None  # Maximum total cost of the commands executed in a turn (see cmd.COMMAND_COSTS), or
+        # None for no limit
+        self.budget_used = 0
+        self.budget_exhausted = False
 
     def current_unit(self):
         return self.queue[-1]
@@ -15,9 +26,21 @@ class TurnHandler:
     def current_player(self):
         return self.current_unit().player_id
 
+    def round_starting(self):
+        # A new round begins on the first turn, or when the next acting unit has already acted this round. A unit
+        # spawned mid-round is added to the queue just ahead of the spawning unit's predecessor, i.e. it acts right
+        # after that predecessor. So it only acts in the round it was spawned in if it was spawned on the first turn
+        # of the round (it then acts last); otherwise its first turn is in the next round, after the predecessor's
+        return self.turn_number == 0 or self.current_unit() in self.acted_this_round
+
     def start_turn(self):
+        if self.round_starting():
+            self.round_number += 1
+            self.acted_this_round.clear()
+        self.acted_this_round.add(self.current_unit())
         self.turn_number += 1
         self.performed_critical_action = False
+        self.reset_budget()
         self.current_unit().on_new_turn()
 
     def end_turn(self):
@@ -31,3 +54,15 @@ class TurnHandler:
 
     def perform_critical_action(self):
         self.performed_critical_action = True
+
+    def reset_budget(self):
+        self.budget_used = 0
+        self.budget_exhausted = False
+
+    def spend_budget(self, cost):
+        # Count the cost of a command against the turn budget. A command which does not fit in what is left of the
+        # budget is not executed, and the turn ends instead
+        if self.budget_used + cost > self.turn_budget:
+            self.budget_exhausted = True
+            raise BudgetExhausted()
+        self.budget_used += cost
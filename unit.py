@@ -1,4 +1,5 @@
 import logging
+import replay
 
 # Setup logging
 logger = logging.getLogger(__name__)
@@ -46,6 +47,8 @@ class Unit:
     def decrement_hp(self, dmg):
         # Reduce hp, check if unit dies
         self.hp -= dmg
+        if self.board.event_recorder is not None:
+            self.board.event_recorder.record(replay.DAMAGE, self, value=dmg)
         logger.log(10, "Unit " + str(self.id) + " took " + str(dmg) + " damage")
         if self.hp <= 0:
             self.kill()
@@ -86,6 +89,8 @@ class Unit:
         # Otherwise, unit hp is decremented
         if self.defending:
             self.defending = False
+            if self.board.event_recorder is not None:
+                self.board.event_recorder.record(replay.DAMAGE, self, value=0)
             logger.log(10, "Unit " + str(self.id) + " defense broken")
             return
         self.decrement_hp(dmg)